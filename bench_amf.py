@@ -0,0 +1,113 @@
+"""Benchmark for pd_tools.fimm.load_amf
+
+Writes a synthetic complex AMF file of the given mesh, and compares the time
+to load it with load_amf against the line by line loader it replaced. Also
+checks that both give the same arrays.
+
+usage: python bench_amf.py [--nx 1024] [--ny 384] [--repeat 3]
+"""
+import argparse
+import os
+import re
+import tempfile
+import time
+
+import numpy
+
+from pd_tools import fimm
+
+HEADER = '''begin <fimmwave field file>
+{nx} {ny} //nxseg nyseg
+-8.0 8.0 -4.0 4.0 //xmin xmax ymin ymax
+1 1 1 1 1 1 //hasEX hasEY hasEZ hasHX hasHY hasHZ
+6.283 0.0 //beta
+1.55 //lambda
+1 //iscomplex
+1 //isWGmode
+//components follow as nyseg by nxseg matrices
+'''
+
+
+def write_amf(path, nx, ny, components=('Ex', 'Ey', 'Ez', 'Hx', 'Hy', 'Hz')):
+    rand = numpy.random.RandomState(0)
+    with open(path, 'w') as f:
+        f.write(HEADER.format(nx=nx, ny=ny))
+        for comp in components:
+            f.write('    //{c} components\n'.format(c=comp))
+            data = rand.standard_normal((nx + 1, 2*(ny + 1)))
+            numpy.savetxt(f, data, fmt='%.6e')
+        f.write('end\n')
+
+
+def load_amf_reference(path):
+    """the line by line loader that load_amf replaced"""
+    with open(path, 'r') as f:
+        results = fimm._read_amf_header(f)
+        iscomplex = results['iscomplex']
+
+        header_re = re.compile(r'\s+//(?P<n>\w+) components')
+        split_re = re.compile(r'\s+')
+        curr_comp = None
+        curr_data = None
+        for line in iter(f.readline, ''):
+            hm = header_re.match(line)
+            if hm is not None:
+                if curr_data is not None:
+                    results[curr_comp] = numpy.array(curr_data).transpose()
+
+                curr_data = []
+                curr_comp = hm.groupdict()['n']
+            elif line.startswith('end'):
+                if curr_data is not None:
+                    results[curr_comp] = numpy.array(curr_data).transpose()
+
+                break
+            else:
+                data = list(map(float, split_re.split(line.strip())))
+                if iscomplex:
+                    data = [complex(*pair) for pair in
+                            numpy.reshape(data, (len(data)//2,2))]
+                curr_data.append(data)
+
+        return results
+
+
+def best_time(loader, path, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        results = loader(path)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--nx', type=int, default=1024)
+    parser.add_argument('--ny', type=int, default=384)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.amf')
+    os.close(fd)
+    try:
+        write_amf(path, args.nx, args.ny)
+        print('%s by %s mesh, %.1f MB' % (
+            args.nx, args.ny, os.path.getsize(path)/1e6))
+
+        new, new_results = best_time(fimm.load_amf, path, args.repeat)
+        old, old_results = best_time(load_amf_reference, path, args.repeat)
+        for comp in ('Ex', 'Ey', 'Ez', 'Hx', 'Hy', 'Hz'):
+            assert numpy.array_equal(new_results[comp], old_results[comp])
+
+        print('%-10s %10s' % ('loader', 'seconds'))
+        print('%-10s %10.3f' % ('reference', old))
+        print('%-10s %10.3f' % ('load_amf', new))
+        print('speedup %.1fx' % (old/new))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Benchmark for the receive engines of pd_tools.PDApp
+
+Serves replies of increasing size from a local pd_tools.mockserver, and
+reports the throughput of each receive engine in MB/s. Only the receive is timed, not the interpretation of the reply.
+
+usage: python bench_recv.py [--engines exact,legacy] [--max-size 100000000]
+"""
+import argparse
+import time
+
+import pd_tools
+from pd_tools.mockserver import MockServer, demo_tree
+
+SIZES = (
+    1000,
+    10000,
+    100000,
+    1000000,
+    10000000,
+    100000000,
+)
+
+
+def measure(connection, size, repeat):
+    """best time to receive a reply, or None if the reply came back short"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        reply = connection._exchange('app.blob(%d);' % size)
+        elapsed = time.time() - start
+        if len(reply) != size + len('RETVAL:\n\0'):
+            return None
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--engines', default='exact,legacy')
+    parser.add_argument('--max-size', type=int, default=SIZES[-1])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    server = MockServer(demo_tree())
+    port = server.start()
+
+    print('%-8s %12s %10s %10s' % ('engine', 'bytes', 'seconds', 'MB/s'))
+    for engine in args.engines.split(','):
+        connection = pd_tools.PDApp(recv_engine=engine)
+        connection.connect('localhost', port)
+        for size in SIZES:
+            if size > args.max_size:
+                break
+            elapsed = measure(connection, size, args.repeat)
+            if elapsed is None:
+                print('%-8s %12d %21s' % (engine, size, 'short read'))
+                break
+            print('%-8s %12d %10.4f %10.1f' % (
+                engine, size, elapsed, size/elapsed/1e6))
+        connection.disconnect()
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 import logging
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
-from wrapper import *
-from connection import *
-import fimm
+from .wrapper import *
+from .connection import *
+from . import fimm
@@ -0,0 +1,151 @@
+"""asyncio client for fimmwave
+
+Speaks the same protocol as PDApp (the space-padded length header, the NUL
+terminated payload and the 'RETVAL:' replies) on asyncio streams, so that a
+single event loop can drive many fimmwave instances at once. Requires Python
+3.5 or later.
+"""
+import asyncio
+import logging
+
+from . import pdPythonLib
+from .connection import _frame, _interpret_reply, _parse_header
+from .wrapper import _convert_arg, _get_help, _parse_help
+
+__all__ = ['AsyncPDApp', 'AsyncNode']
+logger = logging.getLogger(__name__)
+
+# the protocol is 8-bit clean, so decode bytes one-to-one
+_ENCODING = 'latin-1'
+
+
+class AsyncPDApp(object):
+    """asynchronous connection to a single fimmwave instance
+
+    Commands on one connection are sent one at a time, in the order they are
+    awaited. Concurrency comes from awaiting several connections at once, e.g.
+    with asyncio.gather."""
+
+    def __init__(self, host='localhost', port=5101):
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.connect()
+        return await self.wrap('app')
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.disconnect()
+
+    async def connect(self, retries=8):
+        if self._writer is not None:
+            raise ValueError('already connected')
+
+        for i in range(retries):
+            try:
+                self._reader, self._writer = await asyncio.open_connection(
+                    self.host, self.port)
+                return
+            except OSError:
+                logger.debug('connection failed, retrying...')
+                await asyncio.sleep(1)
+        raise ConnectionError('failed to connect to %s:%s' % (
+            self.host, self.port))
+
+    async def disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._reader = None
+
+    async def do(self, cmd):
+        """sends a command and returns the interpreted reply"""
+        logger.debug('exec cmd: %s', repr(cmd))
+        recmsg = await self._exchange(cmd + ';')
+        if recmsg is None:
+            return None
+        return _interpret_reply(recmsg)
+
+    # there is no batch mode, so both are the same
+    do_raise = do
+
+    async def _exchange(self, cmds):
+        """sends a command string and returns the raw reply"""
+        if self._writer is None:
+            raise ValueError('not connected')
+
+        async with self._lock:
+            self._writer.write(_frame(cmds).encode(_ENCODING))
+            await self._writer.drain()
+
+            try:
+                header = await self._reader.readexactly(
+                    pdPythonLib.INTBUFFSIZE)
+            except asyncio.IncompleteReadError:
+                return None
+            msglen = _parse_header(header.decode(_ENCODING))
+            if msglen is None:
+                return None
+
+            recmsg = await self._reader.readexactly(msglen)
+            return recmsg.decode(_ENCODING)
+
+    async def wrap(self, path='app'):
+        """async version of wrapper.wrap
+
+        Checks the node with a 'help' and returns an AsyncNode for it."""
+        info = _parse_help(await _get_help(self, path))
+        return AsyncNode(self, path, info['matchdict']['nodetype'])
+
+
+class AsyncNode(object):
+    """a fimmwave node on an AsyncPDApp
+
+    Attribute access and indexing build paths without any traffic. Traffic
+    only happens when awaiting:
+
+    - `await node` reads the value of the node
+    - `await node(*args)` calls the node as a function
+    - `await node.set(value)` assigns a value to the node
+    - `await node.wrap()` checks the node and fills in its type
+    """
+
+    def __init__(self, pd_app, path, nodetype=None):
+        self._pd_app = pd_app
+        self._path = path
+        self._nodetype = nodetype
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        return AsyncNode(self._pd_app, '{path}.{name}'.format(
+            path=self._path, name=key))
+
+    def __getitem__(self, idx):
+        return AsyncNode(self._pd_app, '{path}[{idx}]'.format(
+            path=self._path, idx=_convert_arg(idx)))
+
+    def __await__(self):
+        return self._pd_app.do(self._path).__await__()
+
+    def __call__(self, *args):
+        return self._pd_app.do('{path}({args})'.format(
+            path=self._path, args=','.join(_convert_arg(a) for a in args)))
+
+    def set(self, value):
+        return self._pd_app.do('{path}={value}'.format(
+            path=self._path, value=_convert_arg(value)))
+
+    def wrap(self):
+        return self._pd_app.wrap(self._path)
+
+    def __str__(self):
+        return '{path}[{nodetype}]'.format(
+            path=self._path, nodetype=self._nodetype)
+
+    def __repr__(self):
+        return '<AsyncNode {path}[{nodetype}]>'.format(
+            path=self._path, nodetype=self._nodetype)
@@ -0,0 +1,349 @@
+"""support for batch mode: buffering of queued commands and their futures"""
+import collections
+import itertools
+import logging
+import re
+import time
+
+__all__ = ['BatchFuture', 'CommandBuffer', 'CommandOptimizer']
+logger = logging.getLogger(__name__)
+
+_assignpat = re.compile(r'\A\s*(?P<path>[^=(\s]+)\s*=(?P<value>.*)\Z', re.S)
+_bindpat = re.compile(r'\A\s*(?:Ref&|Set)\s+(?P<name>\w+)\s*=(?P<cmd>.*)\Z',
+        re.S)
+_callpat = re.compile(r'\A\s*(?P<path>[^=(\s]+)\(.*\)\s*\Z', re.S)
+
+
+def expects_reply(cmd):
+    """whether fimmwave may answer the command with a 'RETVAL:'
+
+    Reads and help return a value, and so may calls, see resolve.
+    Assignments, and binding a variable with 'Ref&' or 'Set', do not."""
+    return not (_assignpat.match(cmd) or _bindpat.match(cmd))
+
+
+def call_name(cmd):
+    """the name of the function a command calls, or None if it is no call"""
+    m = _callpat.match(cmd)
+    if m is None:
+        return None
+    return m.group('path').rsplit('.', 1)[-1]
+
+
+class BatchFuture(object):
+    """the value of a command queued in batch mode
+
+    Resolved when the batch is flushed, from the reply to the command."""
+
+    __slots__ = ('cmd', '_done', '_value', '_exception')
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self._done = False
+        self._value = None
+        self._exception = None
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """returns the value, or raises if the command failed"""
+        if not self._done:
+            raise ValueError('batch not flushed yet: %s' % self.cmd)
+        if self._exception is not None:
+            raise self._exception
+        return self._value
+
+    def set_result(self, value):
+        self._value = value
+        self._done = True
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done = True
+
+    def __repr__(self):
+        if not self._done:
+            state = 'pending'
+        elif self._exception is not None:
+            state = 'failed'
+        else:
+            state = repr(self._value)
+        return '<BatchFuture {cmd} {state}>'.format(cmd=self.cmd, state=state)
+
+
+class CommandBuffer(object):
+    """the commands queued for the next message to fimmwave
+
+    Commands are kept in a list and only joined when the message is sent, so
+    queueing is linear in the size of the batch. The buffer is full once it
+    holds `max_cmds` commands, `max_bytes` bytes, or when its first command
+    was queued more than `max_age` seconds ago (checked as commands are
+    added). Each limit is ignored if it is None."""
+
+    def __init__(self, max_cmds=None, max_bytes=None, max_age=None,
+            optimizer=None):
+        self.max_cmds = max_cmds
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.optimizer = optimizer
+        self._clear()
+
+    def _clear(self):
+        self.cmds = []
+        self.futures = []
+        # the names of the functions called, see resolve
+        self.calls = set()
+        self.nbytes = 0
+        self.started = None
+
+    def __len__(self):
+        return len(self.cmds)
+
+    def add(self, cmd, future=None):
+        if not self.cmds:
+            self.started = time.time()
+        self.cmds.append(cmd)
+        self.nbytes += len(cmd) + 1
+        if future is not None:
+            self.futures.append(future)
+            name = call_name(cmd)
+            if name is not None:
+                self.calls.add(name)
+
+    def full(self):
+        return (
+            self.max_cmds is not None and len(self.cmds) >= self.max_cmds
+            or
+            self.max_bytes is not None and self.nbytes >= self.max_bytes
+            or
+            self.max_age is not None and self.cmds and
+            time.time() - self.started >= self.max_age)
+
+    def drain(self, optimize=False):
+        """empties the buffer, returning the joined commands and futures
+
+        With optimize, the commands are first rewritten by the optimizer.
+        Otherwise the optimizer just takes note of them. The joined commands
+        are empty if no command is left."""
+        cmds = self.cmds
+        if self.optimizer is not None:
+            if optimize:
+                cmds = self.optimizer.optimize(cmds)
+            else:
+                self.optimizer.observe(cmds)
+        futures = self.futures
+        self._clear()
+
+        if not cmds:
+            return '', futures
+        # the trailing semicolon doesn't hurt, as in pdApp.AddCmd
+        return ';'.join(cmds) + ';', futures
+
+
+def _in_scope(path, scope):
+    """whether path is scope itself or lies beneath it"""
+    return (path == scope or path.startswith(scope + '.') or
+            path.startswith(scope + '['))
+
+
+# functions that solve for results without rewriting their inputs
+SOLVER_CALLS = frozenset(['update', 'polishevs'])
+
+
+def changed_scopes(cmd, ignored_calls=()):
+    """the scopes beneath which a command may change values
+
+    Calling a function may change the node that owns the function, unless
+    the function is named in ignored_calls, and binding a variable changes
+    the variable. Returns None if the command may change anything.
+    Assignments are not handled here."""
+    m = _bindpat.match(cmd)
+    if m:
+        scopes = [m.group('name')]
+        cmd = m.group('cmd')
+    else:
+        scopes = []
+
+    m = _callpat.match(cmd)
+    if m:
+        if '.' not in m.group('path'):
+            # no telling what owns the function
+            return None
+        owner, name = m.group('path').rsplit('.', 1)
+        if name not in ignored_calls:
+            scopes.append(owner)
+    elif '(' in cmd:
+        return None
+    return scopes
+
+
+class CommandOptimizer(object):
+    """removes redundant assignments from batches before they are sent
+
+    Within a run of assignments with no call or read in between, only the
+    last assignment to each path is kept. An assignment is dropped entirely
+    if it sets the value that was last sent for that path.
+
+    The last sent values are forgotten when they may have changed behind our
+    back: calling a function forgets the values beneath the node that owns
+    the function, binding a variable forgets the values beneath the variable,
+    and anything unrecognised forgets everything. Every command sent on the
+    connection, batched or not, must therefore go through optimize or
+    observe.
+
+    Variables made by 'Ref&' or 'Set' may alias any node, so only values
+    assigned beneath app are remembered, and assigning or calling beneath a
+    variable forgets everything.
+
+    Calls to the functions named in solver_calls (by default SOLVER_CALLS,
+    e.g. evlist.update()) are taken to only write results, so the parameters
+    assigned before them are remembered across them. A function that does
+    rewrite the values assigned beneath its node must not be among them.
+
+    The savings are counted in `stats`."""
+
+    def __init__(self, solver_calls=SOLVER_CALLS):
+        self.solver_calls = frozenset(solver_calls)
+        self.known = {}
+        self.stats = dict.fromkeys(
+            ('cmds_in', 'cmds_out', 'bytes_in', 'bytes_out'), 0)
+
+    def _forget(self, cmd):
+        """forgets the values a non-assignment command may change"""
+        m = _bindpat.match(cmd)
+        if m:
+            # nothing is remembered beneath the variable itself
+            cmd = m.group('cmd')
+        scopes = changed_scopes(cmd, self.solver_calls)
+        if scopes is None or not all(_in_scope(s, 'app') for s in scopes):
+            self.known.clear()
+        elif scopes:
+            self.known = dict(
+                (path, value) for path, value in self.known.items()
+                if not any(_in_scope(path, scope) for scope in scopes))
+
+    def observe(self, cmds):
+        """takes note of commands that are sent as they are"""
+        for cmd in cmds:
+            m = _assignpat.match(cmd)
+            if m is None:
+                self._forget(cmd)
+            elif _in_scope(m.group('path'), 'app'):
+                self.known[m.group('path')] = m.group('value').strip()
+            else:
+                self.known.clear()
+
+    def optimize(self, cmds):
+        """returns the commands that need to be sent"""
+        out = []
+        run = collections.OrderedDict()
+
+        def end_run():
+            for path, (value, cmd) in run.items():
+                if self.known.get(path) != value:
+                    self.known[path] = value
+                    out.append(cmd)
+            run.clear()
+
+        for cmd in cmds:
+            m = _assignpat.match(cmd)
+            if m and _in_scope(m.group('path'), 'app'):
+                path = m.group('path')
+                # keep the last assignment, in the position of the last one
+                run.pop(path, None)
+                run[path] = (m.group('value').strip(), cmd)
+            elif m:
+                # beneath a variable, which may alias anything
+                end_run()
+                self.known.clear()
+                out.append(cmd)
+            else:
+                end_run()
+                self._forget(cmd)
+                out.append(cmd)
+        end_run()
+
+        bytes_in = sum(len(cmd) + 1 for cmd in cmds)
+        bytes_out = sum(len(cmd) + 1 for cmd in out)
+        self.stats['cmds_in'] += len(cmds)
+        self.stats['cmds_out'] += len(out)
+        self.stats['bytes_in'] += bytes_in
+        self.stats['bytes_out'] += bytes_out
+        logger.debug('coalesced %s commands (%s bytes) into %s (%s bytes)',
+                len(cmds), bytes_in, len(out), bytes_out)
+        return out
+
+
+# unknown functions beyond which replies are not matched by trial
+_MAX_UNKNOWN_CALLS = 12
+
+
+def _answering(futures, nreplies, call_replies, recmsg=None):
+    """which of the commands of futures answered, given nreplies replies
+
+    call_replies holds whether calls to each function answer, by function
+    name. The functions not in it are the ones whose calls, all of them or
+    none, account for the replies that the other commands don't. If that
+    leaves a single possibility, call_replies is updated with it. Returns a
+    list of whether each command answered, or None if there is no telling."""
+    names = [call_name(future.cmd) for future in futures]
+    unknown = sorted(set(name for name in names
+            if name is not None and name not in call_replies))
+    extra = nreplies - sum(1 for name in names
+            if name is None or call_replies.get(name))
+    if unknown:
+        # an error in place of a reply would be taken for a void call
+        if (len(unknown) > _MAX_UNKNOWN_CALLS or
+                recmsg is not None and 'ERROR' in recmsg):
+            return None
+        counts = dict((name, names.count(name)) for name in unknown)
+        matches = [subset
+                for size in range(len(unknown) + 1)
+                for subset in itertools.combinations(unknown, size)
+                if sum(counts[name] for name in subset) == extra]
+        if len(matches) != 1:
+            return None
+        for name in unknown:
+            call_replies[name] = name in matches[0]
+            logger.debug('calls to %s %s', name,
+                    'answer' if call_replies[name] else 'do not answer')
+    elif extra != 0:
+        return None
+    return [name is None or call_replies[name] for name in names]
+
+
+def resolve(futures, replies, recmsg=None, call_replies=None):
+    """resolves futures in order from the interpreted replies
+
+    Fimmwave may or may not answer a call to a function that returns
+    nothing. With call_replies, a dict of whether calls answer by function
+    name, that is learnt from the number of replies (see _answering), and
+    the futures of calls that don't answer resolve to None. Without it,
+    every command is taken to answer.
+
+    If the replies cannot be matched to the commands, there is no telling
+    which reply belongs to which command, so all of them fail. Returns
+    whether the replies were matched."""
+    if call_replies is None:
+        answering = [True]*len(futures)
+        if len(replies) != len(futures):
+            answering = None
+    else:
+        answering = _answering(futures, len(replies), call_replies, recmsg)
+
+    if answering is None:
+        if recmsg is not None and not replies:
+            error = ValueError(recmsg)
+        else:
+            error = ValueError('%s replies for %s commands' % (
+                len(replies), len(futures)))
+        logger.warn('could not resolve batch: %s', error)
+        for future in futures:
+            future.set_exception(error)
+        return False
+
+    replies = iter(replies)
+    for future, answered in zip(futures, answering):
+        future.set_result(next(replies) if answered else None)
+    return True
@@ -0,0 +1,97 @@
+"""client-side cache of the values of primitive nodes"""
+import collections
+import logging
+
+from .batch import _assignpat, _bindpat, _in_scope, changed_scopes
+
+__all__ = ['ValueCache']
+logger = logging.getLogger(__name__)
+
+
+class ValueCache(object):
+    """LRU cache of values read from fimmwave, by path
+
+    Holds at most `maxsize` values. Every command sent on the connection must
+    go through observe, which drops the values the command may change: an
+    assignment drops the value of its path, calling a function drops the
+    values beneath the node that owns the function, and anything
+    unrecognised drops everything.
+
+    Variables made by 'Ref&' or 'Set' may alias any node, so values are only
+    cached by their path beneath app, and assigning or calling beneath a
+    variable drops everything.
+
+    Hits and misses are counted in `stats`."""
+
+    def __init__(self, maxsize=1024):
+        if maxsize < 1:
+            raise ValueError('maxsize must be positive')
+        self.maxsize = maxsize
+        self.values = collections.OrderedDict()
+        self.stats = dict.fromkeys(('hits', 'misses', 'evictions'), 0)
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, path, default=None):
+        if not _in_scope(path, 'app'):
+            return default
+        try:
+            value = self.values.pop(path)
+        except KeyError:
+            self.stats['misses'] += 1
+            return default
+        # move to the most recently used end
+        self.values[path] = value
+        self.stats['hits'] += 1
+        return value
+
+    def put(self, path, value):
+        if not _in_scope(path, 'app'):
+            return
+        self.values.pop(path, None)
+        self.values[path] = value
+        if len(self.values) > self.maxsize:
+            self.values.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def invalidate(self, scope):
+        """drops the values of scope and everything beneath it
+
+        Everything is dropped for a scope beneath a variable."""
+        if not _in_scope(scope, 'app'):
+            self.clear()
+            return
+        for path in [p for p in self.values if _in_scope(p, scope)]:
+            del self.values[path]
+
+    def clear(self):
+        self.values.clear()
+
+    def observe(self, cmd):
+        """drops the values a command may change"""
+        if ';' in cmd.strip().rstrip(';'):
+            # several commands in one, don't bother
+            self.clear()
+            return
+
+        m = _assignpat.match(cmd)
+        if m:
+            self.invalidate(m.group('path'))
+            return
+
+        m = _bindpat.match(cmd)
+        if m:
+            # nothing is cached beneath the variable itself
+            cmd = m.group('cmd')
+        scopes = changed_scopes(cmd)
+        if scopes is None:
+            logger.debug('clearing value cache for %s', repr(cmd))
+            self.clear()
+        else:
+            for scope in scopes:
+                self.invalidate(scope)
+
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return float(self.stats['hits'])/lookups if lookups else 0.
@@ -1,15 +1,31 @@
+import contextlib
+import errno
 import logging
+import math
 import os
 import random
 import socket
+import threading
 import time
 import re
 
-import pdPythonLib
+import numpy
 
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+from . import pdPythonLib
+
+from .batch import (BatchFuture, CommandBuffer, CommandOptimizer,
+        _in_scope, call_name, expects_reply, resolve)
+from .cache import ValueCache
+from .instrument import PHASES, command_kind, timer
+from .refs import RefPool
 from .wrapper import wrap
 
-__all__ = ['connect', 'PDApp']
+__all__ = ['connect', 'PDApp', 'PDAppPool']
 logger = logging.getLogger(__name__)
 
 testpat = re.compile(r""".*""", re.X | re.M | re.S)
@@ -133,6 +149,122 @@ def getNumOrStr(msgstr):
     return msgstr
 pdPythonLib.getNumOrStr = getNumOrStr
 
+def _split_replies(recmsg):
+    """split a raw reply into its interpreted 'RETVAL:' sections
+
+    Always returns a list, with one entry per 'RETVAL:' found in the reply.
+    This is the same splitting that pdApp.Exec does for multiple return
+    values."""
+    replies = []
+    start = recmsg.find('RETVAL:')
+    if start == -1:
+        return replies
+
+    while True:
+        nxt = recmsg.find('RETVAL:', start + 1)
+        if nxt == -1:
+            replies.append(pdPythonLib.InterpretString3(recmsg[start:]))
+            return replies
+        replies.append(pdPythonLib.InterpretString3(recmsg[start:nxt]))
+        start = nxt
+
+def _interpret_reply(recmsg):
+    """interpret a raw reply the same way pdApp.Exec does
+
+    No 'RETVAL:' returns the message as-is (usually an error), a single one
+    returns the interpreted value, and several return a list of values."""
+    replies = _split_replies(recmsg)
+    if not replies:
+        return recmsg
+    elif len(replies) == 1:
+        return replies[0]
+    else:
+        return replies
+
+def decode_matrix(recmsg):
+    """decodes a 'RETVAL:' matrix reply straight into a numpy array
+
+    Faster, leaner alternative to InterpretString3 for numeric matrices.
+    Instead of matching every line, the label name and the brackets are
+    blanked out of the whole body at once, which leaves columns of indices
+    and values that numpy parses in bulk. No python object is made per
+    element. Values of the form '(re,im)' give a complex array.
+
+    Raises ValueError if the reply is not a fully numeric 1d or 2d matrix."""
+    m = retmsgpat.match(recmsg)
+    if not m:
+        raise ValueError('not a single return value')
+    body = m.group('body')
+
+    # the first and last labels give the shape of the matrix
+    end = body.find('\n')
+    firstline = body if end == -1 else body[:end]
+    lastline = body[body.rfind('\n') + 1:]
+    if not firstline.split() or not lastline.split():
+        raise ValueError('not a matrix')
+    first = listlabelpat.match(firstline.split()[0])
+    last = listlabelpat.match(lastline.split()[0])
+    if not first or not last:
+        raise ValueError('not a matrix')
+
+    start = [int(first.group('idx1'))]
+    shape = [int(last.group('idx1')) - start[0] + 1]
+    if first.group('idx2'):
+        start.append(int(first.group('idx2')))
+        shape.append(int(last.group('idx2')) - start[1] + 1)
+
+    # a label that looks like part of a number can't be blanked out safely
+    label = first.group('label')
+    if not label.strip('0123456789.eE+-'):
+        raise ValueError('ambiguous label %s' % repr(label))
+
+    iscomplex = '(' in body
+    ndim = len(shape)
+    ncols = ndim + (2 if iscomplex else 1)
+    count = int(numpy.prod(shape))
+
+    columns = body.replace(label, ' ')
+    for c in '[](),':
+        columns = columns.replace(c, ' ')
+    data = numpy.fromstring(columns, dtype=numpy.float64, sep=' ')
+    if data.size != count*ncols:
+        raise ValueError('expected %s numbers, got %s' % (
+            count*ncols, data.size))
+    data = data.reshape(count, ncols)
+
+    # the indices must run through the matrix in order
+    expected = numpy.indices(shape).reshape(ndim, count).T + start
+    if not numpy.array_equal(data[:, :ndim], expected):
+        raise ValueError('matrix elements out of order')
+
+    values = numpy.ascontiguousarray(data[:, ndim:])
+    if iscomplex:
+        values = values.view(numpy.complex128)
+    return values.reshape(shape)
+
+def _decode_or_interpret(recmsg):
+    """decode_matrix, falling back to the usual interpretation"""
+    try:
+        return decode_matrix(recmsg)
+    except ValueError:
+        return _interpret_reply(recmsg)
+
+def _frame(cmds):
+    """frame a command string the way fimmwave expects it
+
+    The length of the message (including the terminating NUL) is sent as a
+    space-padded header of INTBUFFSIZE bytes."""
+    header = repr(len(cmds) + 1)
+    return (header + (pdPythonLib.INTBUFFSIZE - len(header))*' ' +
+            cmds + '\0')
+
+def _parse_header(header):
+    """returns the length announced by a reply header, or None"""
+    try:
+        return int(header.split('\x00', 1)[0])
+    except ValueError:
+        return None # probably a app.exit command
+
 def start(path, port=None):
     connection = PDApp()
     connection.start(path, port)
@@ -153,19 +285,66 @@ class PDApp(pdPythonLib.pdApp):
     - add support for 'with' statement.
     - alias methods to a more pythonic naming scheme
     - bypasses hairbrained port management
+    - replies are received by a selectable engine. 'exact' (the default)
+      reads exactly the announced length into a preallocated buffer, while
+      'legacy' reproduces the chunked, sleeping reads of pdApp.Exec
+    - with numpy_matrices, wrapped MATRIX<COMPLEX> attributes are read as
+      numpy arrays by decode_matrix
+    - in batch mode, commands are queued in a CommandBuffer, which is sent
+      automatically as soon as it holds max_batch_cmds commands or
+      max_batch_bytes bytes, or has been filling for max_batch_age seconds.
+      Whether calls to a function answer is learnt the first time it is
+      called in a batch, see batch.resolve
+    - with coalesce, redundant assignments are removed from batches by a
+      CommandOptimizer before they are sent. Parameters assigned before a
+      solver call such as evlist.update() are not sent again unless they
+      change, see optimizer.solver_calls
+    - with a schema_cache (see wrapper.SchemaCache), wrapped nodes of known
+      types are set up without asking for help. The cache is saved on
+      disconnect
+    - wrapped nodes share one class per node type, so help is asked once per
+      type rather than once per node. With infer_item_types, the elements of
+      a list are also assumed to be of the type of its other elements, until
+      one turns out different
+    - with a cache_size, the values of wrapped primitive nodes are kept in a
+      ValueCache of that many values, so they are only read once until a
+      command may have changed them. Assignments write through to the cache
+    - the variables made by ref and set are released once their wrapped nodes
+      are garbage collected, or on release, and their names are reused. See
+      refs.RefPool
+    - with a recorder (see instrument.Recorder), the send, wait, receive and
+      decode times of every exchange are recorded by kind of command
     """
 
     ports_in_use = set()
+    RECV_ENGINES = ('exact', 'legacy')
 
-    def __init__(self, path=None, host=None, port=None, batch=False):
+    def __init__(self, path=None, host=None, port=None, batch=False,
+            recv_engine='exact', numpy_matrices=False, max_batch_cmds=None,
+            max_batch_bytes=None, max_batch_age=None, coalesce=False,
+            schema_cache=None, infer_item_types=False, cache_size=None,
+            recorder=None):
         # inheriting from old style class requires explicit call to __init__
         pdPythonLib.pdApp.__init__(self)
 
+        if recv_engine not in self.RECV_ENGINES:
+            raise ValueError('unknown receive engine %s' % repr(recv_engine))
+
         self.host = host
         self.path = path
         self.port = port
         self.batch = batch
-        self.refcount = 0
+        self.recv_engine = recv_engine
+        self.numpy_matrices = numpy_matrices
+        self.schema_cache = schema_cache
+        self.infer_item_types = infer_item_types
+        self.value_cache = ValueCache(cache_size) if cache_size else None
+        self.recorder = recorder
+        self.refs = RefPool()
+        self.optimizer = CommandOptimizer() if coalesce else None
+        self._cmdbuf = CommandBuffer(
+            max_batch_cmds, max_batch_bytes, max_batch_age, self.optimizer)
+        self._chunks = []
 
     def __enter__(self):
         """Connect to fimmwave"""
@@ -216,8 +395,21 @@ class PDApp(pdPythonLib.pdApp):
 
         self.connect('localhost', port)
 
-    def connect(self, host, port):
+    def _reset(self):
+        """forgets the state of the previous connection"""
+        # node classes by node type, the types of nodes by path, and the
+        # types of list elements by (list type, list name)
         self._cls_cache = {}
+        self._path_types = {}
+        self._item_types = {}
+        # whether calls answer, by function name, see batch.resolve
+        self._call_replies = {}
+        self.refs = RefPool()
+        if self.value_cache is not None:
+            self.value_cache.clear()
+
+    def connect(self, host, port):
+        self._reset()
 
         if self.appSock:
             raise ValueError('already connected')
@@ -242,34 +434,242 @@ class PDApp(pdPythonLib.pdApp):
 
 
     def disconnect(self):
-        if self.cmdList:
+        if len(self._cmdbuf):
             logger.warn('there are pending commands')
 
         if self.appSock is not None:
             self.appSock.close()
             self.appSock = None
-            self.ports_in_use.remove(self._port)
+            self.ports_in_use.discard(self._port)
+
+        if self.schema_cache is not None:
+            self.schema_cache.save()
+
+    def Exec(self, commStr, varList=[], decoder=_interpret_reply):
+        """sends the pending commands plus commStr, and decodes the reply
+
+        In batch mode, the futures of the queued commands are resolved from
+        the same reply."""
+        if self.appSock is None:
+            return "application not initialised\n"
+
+        self.AddCmd(commStr, varList)
+        cmds, futures = self._cmdbuf.drain()
+
+        recmsg = self._exchange(cmds)
+        if futures and self.batch:
+            logger.debug('resolving %s queued values', len(futures) - 1)
+            if recmsg is None:
+                resolve(futures, [], 'no reply')
+            else:
+                resolve(futures, _split_replies(recmsg), recmsg,
+                        self._call_replies)
+        if recmsg is None:
+            return None
+        return self._decode(command_kind(commStr), recmsg, decoder)
+
+    def AddCmd(self, commStr, varList=[]):
+        """queues a command, returns a BatchFuture if it returns a value"""
+        commStr = pdPythonLib.InterpretString(commStr, varList)
+        if self.refs.pending():
+            # free released variables along with this command
+            for cmd in self.refs.drain():
+                self._observe(cmd)
+                self._cmdbuf.add(cmd)
+
+        self._observe(commStr)
+        if expects_reply(commStr):
+            future = BatchFuture(commStr)
+            if self.batch and self._new_call(commStr):
+                self._send_chunk()
+        else:
+            future = None
+
+        self._cmdbuf.add(commStr, future)
+        if self.batch and self._cmdbuf.full():
+            logger.debug('command buffer full, sending %s commands',
+                    len(self._cmdbuf))
+            self._send_chunk()
+        return future
+
+    def _new_call(self, cmd):
+        """whether cmd calls a function that may or may not answer, while
+        the queued commands call another such function
+
+        There must be one such function per message at most, so that
+        whether it answers can be told from the number of replies, see
+        batch.resolve."""
+        name = call_name(cmd)
+        return (name is not None and name not in self._call_replies and
+                bool(self._cmdbuf.calls - set(self._call_replies) - {name}))
+
+    def _observe(self, cmd):
+        if self.value_cache is not None:
+            self.value_cache.observe(cmd)
+
+    def _send_chunk(self):
+        """sends the queued commands and resolves their futures"""
+        cmds, futures = self._cmdbuf.drain(optimize=True)
+        if not cmds:
+            # all optimized away
+            resolve(futures, [])
+            return
+
+        recmsg = self._exchange(cmds)
+        if recmsg is None:
+            resolve(futures, [], 'no reply')
+            self._chunks.append([])
+            return
+
+        replies = self._decode('flush', recmsg, _split_replies)
+        matched = resolve(futures, replies, recmsg, self._call_replies)
+        if replies:
+            self._chunks.append(replies)
+        elif not matched:
+            # no reply where one was expected, most likely an error
+            self._chunks.append([recmsg])
+
+    def _exchange(self, cmds):
+        """sends a command string and returns the raw reply
+
+        With a recorder, the time of each step is noted in self._sample, for
+        _decode to record. An exchange without a reply is recorded at once,
+        as kind 'lost'."""
+        frame = _frame(cmds)
+        if self.recorder is None:
+            self.appSock.sendall(frame)
+            return self._recv_reply()
+
+        times = [timer()]
+        self.appSock.sendall(frame)
+        times.append(timer())
+        recmsg = self._recv_reply(times)
+        times.append(timer())
+        self._sample = {
+            'cmds': cmds.count(';'),
+            'bytes_sent': len(frame),
+            'bytes_recv': pdPythonLib.INTBUFFSIZE + len(recmsg or ''),
+            'send': times[1] - times[0],
+            'wait': times[2] - times[1],
+            'recv': times[3] - times[2],
+        }
+        if recmsg is None:
+            self._record_sample('lost', 0.)
+        return recmsg
+
+    def _decode(self, kind, recmsg, decoder):
+        """decodes a reply, recording it along with its exchange"""
+        if self.recorder is None:
+            return decoder(recmsg)
+
+        start = timer()
+        try:
+            return decoder(recmsg)
+        finally:
+            self._record_sample(kind, timer() - start)
+
+    def _record_sample(self, kind, decode):
+        """hands the sample of the last exchange to the recorder"""
+        sample = self._sample
+        sample['decode'] = decode
+        sample['kind'] = kind
+        sample['total'] = sum(sample[phase] for phase in PHASES)
+        self.recorder.record(sample)
+
+    def _recv_reply(self, times=None):
+        """receives a reply, noting when its header arrived in times"""
+        header = self._recv_exact(pdPythonLib.INTBUFFSIZE)
+        if times is not None:
+            times.append(timer())
+        if header is None:
+            return None
+        msglen = _parse_header(header)
+        if msglen is None:
+            return None
+
+        if self.recv_engine == 'legacy':
+            return self._recv_legacy(msglen)
+
+        recmsg = self._recv_exact(msglen)
+        if recmsg is None:
+            raise socket.error(errno.ECONNRESET,
+                    'connection closed while receiving reply')
+        return recmsg
+
+    def _recv_exact(self, msglen):
+        """receives exactly msglen bytes, or None if the connection closes
+
+        The reply is read straight into a buffer of the announced length, so
+        there is a single copy and no sleeping between reads. Short reads are
+        simply continued from where they stopped."""
+        buf = bytearray(msglen)
+        view = memoryview(buf)
+        received = 0
+        while received < msglen:
+            try:
+                n = self.appSock.recv_into(view[received:], msglen - received)
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if n == 0:
+                if received:
+                    logger.error('connection closed after %s of %s bytes',
+                            received, msglen)
+                return None
+            received += n
+        return bytes(buf)
+
+    def _recv_legacy(self, msglen):
+        """receives msglen bytes the way pdApp.Exec does"""
+        if msglen <= pdPythonLib.MaxBuffSize:
+            return self.appSock.recv(msglen)
+
+        recmsg = ''
+        batches = int(math.ceil(float(msglen)/pdPythonLib.MaxBuffSize))
+        for i in range(batches):
+            recmsg = recmsg + self.appSock.recv(pdPythonLib.MaxBuffSize)
+            time.sleep(pdPythonLib.delay)
+
+        if len(recmsg) < msglen:
+            logger.warn('received %s of %s bytes, reduce MaxBuffSize or '
+                    'increase delay in pdPythonLib', len(recmsg), msglen)
+        return recmsg
 
     def ref(self, cmd):
         """calls the command, but creates a ref of the output.
 
         calls the command and creates a reference. then wraps that reference
-        and returns the wrapped thing"""
+        and returns the wrapped thing. The variable is released when the
+        wrapped nodes are garbage collected, see release"""
+        return self._bind('Ref&', cmd)
 
-        refname = "xx{idx}".format(idx=self.refcount)
-        self.refcount += 1
+    def set(self, cmd):
+        return self._bind('Set', cmd)
 
-        self.do("Ref& {r}={cmd}".format(r=refname, cmd=cmd))
-        return wrap(self, refname)
+    def _bind(self, kind, cmd):
+        ref = self.refs.acquire()
+        # a reused name may refer to a node of another type now
+        self._path_types = dict(
+            (path, nodetype) for path, nodetype in self._path_types.items()
+            if not _in_scope(path, ref.name))
+        self.do("{kind} {r}={cmd}".format(kind=kind, r=ref.name, cmd=cmd))
+        return wrap(self, ref.name, owner=ref)
 
-    def set(self, cmd):
-        refname = "xx{idx}".format(idx=self.refcount)
-        self.refcount += 1
+    def release(self, node):
+        """releases the variable behind a node made by ref or set
 
-        self.do("Set {r}={cmd}".format(r=refname, cmd=cmd))
-        return wrap(self, refname)
+        The variable is freed along with the next command. Nodes beneath it
+        must not be used after this."""
+        if node._owner is None:
+            raise ValueError('not a reference: %s' % node._path)
+        self.refs.release(node._owner)
 
     def do(self, cmd):
+        """executes cmd, or queues it in batch mode
+
+        In batch mode, commands that return a value give a BatchFuture, which
+        is resolved by the next flush."""
         if self.batch:
             logger.debug('batch cmd: %s', repr(cmd))
             return self.AddCmd(cmd)
@@ -284,15 +684,353 @@ class PDApp(pdPythonLib.pdApp):
             logger.debug('exec cmd: %s', repr(cmd))
             return self.Exec(cmd)
 
+    def get_array(self, path):
+        """reads a numeric matrix as a numpy array, see decode_matrix
+
+        Replies that are not numeric matrices are interpreted as usual."""
+        if self.batch:
+            raise ValueError('batch mode is ON')
+        else:
+            logger.debug('exec cmd: %s', repr(path))
+            return self.Exec(path, decoder=_decode_or_interpret)
+
+    def get_paths(self, paths):
+        """reads several values in one round trip
+
+        Each path is a node to read, or a function to call, as in
+        'app.subnodes[1].evlist.list[1].neff()'. Returns a tuple of the
+        values in order, or of BatchFutures in batch mode. Calls that don't
+        answer and commands that expect no reply, such as assignments, give
+        None. Raises ValueError if any of them fails."""
+        paths = list(paths)
+        if self.batch:
+            return tuple(self.do(path) for path in paths)
+        if not paths:
+            return ()
+
+        futures = []
+        for path in paths:
+            if self._new_call(path):
+                self._get_queued()
+            futures.append(self.AddCmd(path))
+        self._get_queued()
+        return tuple(None if future is None else future.result()
+                for future in futures)
+
+    def _get_queued(self):
+        """sends the queued commands and resolves their futures
+
+        Raises ValueError if the replies don't match the commands."""
+        cmds, futures = self._cmdbuf.drain()
+        logger.debug('exec cmds: %s', repr(cmds))
+
+        recmsg = self._exchange(cmds)
+        if recmsg is None:
+            raise ValueError('no reply')
+        replies = self._decode('get', recmsg, _split_replies)
+        if not resolve(futures, replies, recmsg, self._call_replies):
+            raise ValueError(recmsg)
+
     def toggle_mode(self):
         if self.batch:
             self.flush()
 
         self.batch = not self.batch
 
-    def flush(self):
+    def flush(self, chunks=False):
+        """sends the queued commands, resolving their futures
+
+        Returns the values of all the replies since the last flush, including
+        those of commands that were sent automatically because the buffer was
+        full. With chunks, returns a list of the replies to each message
+        instead."""
         if self.batch:
             logger.debug('flushing batched commands')
-            return self.Exec('app') # 'app' is a dummy value
+            self.AddCmd('app') # 'app' is a dummy value
+            if len(self._cmdbuf):
+                self._send_chunk()
+
+            sent = self._chunks
+            self._chunks = []
+            if chunks:
+                return sent
+
+            replies = [reply for chunk in sent for reply in chunk]
+            if len(replies) == 1:
+                return replies[0]
+            return replies
         else:
             raise ValueError('batch mode is OFF')
+
+class PoolJob(object):
+    """the pending result of a job submitted to a PDAppPool"""
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError('job not finished after %s s' % timeout)
+        return self._exception
+
+    def result(self, timeout=None):
+        """waits for the job, and returns its result or raises its error"""
+        if self.exception(timeout) is not None:
+            raise self._exception
+        return self._result
+
+
+class _PoolMember(object):
+    def __init__(self, connection, port):
+        self.connection = connection
+        self.port = port
+        self.app = wrap(connection, 'app')
+
+
+class PDAppPool(object):
+    """a pool of fimmwave instances for running independent jobs in parallel
+
+    Either starts `size` instances of the executable at `path`, or connects to
+    already running instances on `host` at each of `ports`. The optional
+    `setup` is replayed on every instance when it is (re)connected, and can be
+    a function taking the wrapped app, or a list of command strings.
+
+    Jobs are functions taking the wrapped app as their first argument. At
+    most `max_workers` of them run at once, each on an instance leased
+    exclusively for the duration of the job. An instance whose job fails with
+    a socket error, or that fails a health check, is replaced. If a failed
+    job's instance cannot be replaced, the pool carries on without it.
+
+        with PDAppPool(4, path=FIMMWAVE, setup=build) as pool:
+            jobs = [pool.submit(solve, w) for w in widths]
+            results = [job.result() for job in jobs]
+    """
+
+    # seconds between checks that the pool still has instances
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, size=None, path=None, host='localhost', ports=None,
+            setup=None, max_workers=None):
+        if path is None and ports is None:
+            raise ValueError('provide either path or ports')
+        if ports is None:
+            if size is None or size < 1:
+                raise ValueError('provide the number of instances to start')
+            free = [port for port in range(5000, 6000)
+                    if port not in PDApp.ports_in_use]
+            ports = random.sample(free, size)
+        elif size is not None and size != len(ports):
+            raise ValueError('size does not match the number of ports')
+
+        self.path = path
+        self.host = host
+        self.setup = setup
+        self.max_workers = max_workers or len(ports)
+        self.size = len(ports)
+
+        self._idle = Queue.Queue()
+        self._jobs = Queue.Queue()
+        self._workers = []
+        self._closed = False
+        self._lock = threading.Lock()
+
+        try:
+            for port in ports:
+                self._idle.put(self._open(port))
+        except Exception:
+            while not self._idle.empty():
+                self._idle.get().connection.disconnect()
+            raise
+
+        for i in range(self.max_workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _open(self, port):
+        """starts or connects to an instance and replays the setup on it"""
+        connection = PDApp()
+        if self.path:
+            connection.start(self.path, port)
+        else:
+            connection.connect(self.host, port)
+        if connection.appSock is None:
+            raise socket.error('failed to connect to port %s' % port)
+
+        member = _PoolMember(connection, port)
+        try:
+            if callable(self.setup):
+                self.setup(member.app)
+            elif self.setup:
+                for cmd in self.setup:
+                    connection.do(cmd)
+        except Exception:
+            connection.disconnect()
+            raise
+
+        logger.debug('pool instance on port %s ready', port)
+        return member
+
+    def _replace(self, member):
+        """drops a broken instance and opens a new one in its place"""
+        logger.warn('replacing pool instance on port %s', member.port)
+        try:
+            member.connection.disconnect()
+        except (socket.error, KeyError):
+            pass
+
+        if self.path:
+            # the old instance may still hold on to its port
+            free = [port for port in range(5000, 6000)
+                    if port not in PDApp.ports_in_use and port != member.port]
+            port = random.choice(free)
+        else:
+            port = member.port
+        return self._open(port)
+
+    def _replace_or_drop(self, member, error):
+        """replaces a member that failed with error, or drops it
+
+        Returns the new member, or None if it could not be replaced, in which
+        case the pool is one instance smaller."""
+        try:
+            return self._replace(member)
+        except Exception as e:
+            logger.error('could not replace instance after %s: %s',
+                    repr(error), repr(e))
+        try:
+            member.connection.disconnect()
+        except (socket.error, KeyError):
+            pass
+        with self._lock:
+            self.size -= 1
+        return None
+
+    def _ping(self, member):
+        if member.connection.appSock is None:
+            return False
+        try:
+            return member.connection.do_raise('app') is not None
+        except socket.error:
+            return False
+
+    def health_check(self):
+        """pings every idle instance and replaces the ones that are down
+
+        Instances that cannot be replaced are dropped. Returns the number of
+        instances that were replaced."""
+        members = []
+        while True:
+            try:
+                members.append(self._idle.get_nowait())
+            except Queue.Empty:
+                break
+
+        replaced = 0
+        for member in members:
+            if not self._ping(member):
+                member = self._replace_or_drop(member, 'failed health check')
+                if member is None:
+                    continue
+                replaced += 1
+            self._idle.put(member)
+        return replaced
+
+    @contextlib.contextmanager
+    def lease(self, timeout=None):
+        """exclusively borrows an instance, yielding its wrapped app"""
+        if self._closed:
+            raise ValueError('pool is closed')
+        member = self._wait_idle(timeout)
+
+        try:
+            yield member.app
+        except socket.error as e:
+            member = self._replace_or_drop(member, e)
+            raise
+        finally:
+            if member is not None:
+                self._idle.put(member)
+
+    def _wait_idle(self, timeout=None):
+        """takes an idle member, giving up once none are left"""
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            # instances may be dropped while waiting
+            if not self.size:
+                raise RuntimeError('no instances left in the pool')
+            wait = self.POLL_INTERVAL
+            if timeout is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    raise RuntimeError(
+                            'no instance free after %s s' % timeout)
+            try:
+                return self._idle.get(timeout=wait)
+            except Queue.Empty:
+                pass
+
+    def submit(self, fn, *args, **kwargs):
+        """queues fn(app, *args, **kwargs) and returns its PoolJob"""
+        if self._closed:
+            raise ValueError('pool is closed')
+        job = PoolJob(fn, args, kwargs)
+        self._jobs.put(job)
+        return job
+
+    def map(self, fn, iterable):
+        """runs fn(app, item) for every item, returning results in order"""
+        jobs = [self.submit(fn, item) for item in iterable]
+        return [job.result() for job in jobs]
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            try:
+                with self.lease() as app:
+                    job._result = job.fn(app, *job.args, **job.kwargs)
+            except Exception as e:
+                logger.debug('pool job failed: %s', repr(e))
+                job._exception = e
+            job._done.set()
+
+    def close(self):
+        """waits for the queued jobs, then disconnects every instance"""
+        if self._closed:
+            return
+        self._closed = True
+
+        for worker in self._workers:
+            self._jobs.put(None)
+        for worker in self._workers:
+            worker.join()
+
+        for i in range(self.size):
+            member = self._idle.get()
+            member.connection.disconnect()
+
+
+try:
+    from .aio import AsyncPDApp
+    __all__.append('AsyncPDApp')
+except (ImportError, SyntaxError):
+    # the asyncio client needs python 3.5+
+    pass
@@ -0,0 +1,147 @@
+"""analysis of mode fields loaded from AMF files
+
+Works on the dicts returned by fimm.load_amf (one mode, arrays of shape
+(ny+1, nx+1)), fimm.LazyAMF, and fimm.load_amf_many (n modes stacked in
+arrays of shape (n, ny+1, nx+1), which may be memmaps). Integrals are sums
+over the mesh points times the area of a mesh cell, dx*dy, where
+dx = (xmax - xmin)/nx and dy = (ymax - ymin)/ny.
+
+    modes = fimm.load_amf_many(paths, workers=4)
+    areas = effective_area(modes)
+    overlaps = overlap(modes, normalized=True)   # n by n
+
+Large stacks are processed in chunks, so that the temporaries stay within
+max_bytes whatever the number of modes and the size of the mesh.
+"""
+import logging
+
+import numpy
+
+__all__ = ['grid_step', 'power', 'normalize', 'overlap', 'effective_area']
+logger = logging.getLogger(__name__)
+
+# the default memory budget for temporaries, in bytes
+MAX_BYTES = 256*2**20
+
+
+def grid_step(fields):
+    """returns the (dx, dy) of the mesh of a dict of fields"""
+    if 'meta' in fields:
+        meta = fields['meta']
+        for key in ('nx', 'ny', 'xmin', 'xmax', 'ymin', 'ymax'):
+            if not (meta[key] == meta[key][0]).all():
+                raise ValueError('modes are on different meshes')
+        header = meta[0]
+    else:
+        header = fields
+    nx, ny = int(header['nx']), int(header['ny'])
+    return ((float(header['xmax']) - float(header['xmin']))/nx,
+            (float(header['ymax']) - float(header['ymin']))/ny)
+
+
+def _stack(fields, comp):
+    """a component as a 2d array of modes by mesh points"""
+    array = fields[comp]
+    if array.ndim == 2:
+        array = array[numpy.newaxis]
+    return array.reshape(array.shape[0], -1)
+
+
+def _chunks(n, item_bytes, max_bytes):
+    """yields slices of range(n), each of at most max_bytes worth of items"""
+    size = max(1, int(max_bytes // max(item_bytes, 1)))
+    for start in range(0, n, size):
+        yield slice(start, min(start + size, n))
+
+
+def power(fields, max_bytes=MAX_BYTES):
+    """the power of each mode, 0.5*Re integral of (Ex Hy* - Ey Hx*)
+
+    Returns an array with an element per mode, or a float for a single
+    mode."""
+    dx, dy = grid_step(fields)
+    ex, ey, hx, hy = [_stack(fields, c) for c in ('Ex', 'Ey', 'Hx', 'Hy')]
+    n, npoints = ex.shape
+
+    p = numpy.empty(n)
+    for s in _chunks(n, 6*16*npoints, max_bytes):
+        p[s] = 0.5*dx*dy*numpy.real(
+            (ex[s]*hy[s].conj()).sum(axis=1) -
+            (ey[s]*hx[s].conj()).sum(axis=1))
+    return p if fields['Ex'].ndim == 3 else p[0]
+
+
+def normalize(fields):
+    """returns a copy of fields, scaled to unit power
+
+    The scaled components are held in memory. To compare large stacks of
+    normalized modes, use overlap(..., normalized=True) instead."""
+    p = numpy.atleast_1d(power(fields))
+    if (p <= 0).any():
+        raise ValueError('cannot normalize modes of no power')
+    scale = 1/numpy.sqrt(p)
+
+    normalized = dict(fields)
+    for comp in ('Ex', 'Ey', 'Ez', 'Hx', 'Hy', 'Hz'):
+        if comp in fields:
+            array = numpy.asarray(fields[comp])
+            if array.ndim == 3:
+                normalized[comp] = array*scale[:, numpy.newaxis, numpy.newaxis]
+            else:
+                normalized[comp] = array*scale[0]
+    return normalized
+
+
+def overlap(a, b=None, normalized=False, max_bytes=MAX_BYTES):
+    """the overlap matrix of the modes of a with those of b
+
+    Element (i, j) is 0.5 * integral of (Ex_a[i] Hy_b[j]* - Ey_a[i] Hx_b[j]*).
+    b defaults to a. With normalized, each element is divided by the square
+    root of the powers of both modes, as if they had been normalized.
+
+    The integrals are accumulated by matrix products over chunks of the
+    mesh, so only chunks of the modes are in memory at once."""
+    if b is None:
+        b = a
+    dx, dy = grid_step(a)
+    if grid_step(b) != (dx, dy):
+        raise ValueError('modes are on different meshes')
+
+    ex, ey = _stack(a, 'Ex'), _stack(a, 'Ey')
+    hx, hy = _stack(b, 'Hx'), _stack(b, 'Hy')
+    if ex.shape[1] != hx.shape[1]:
+        raise ValueError('modes have different numbers of mesh points')
+    m, n = ex.shape[0], hx.shape[0]
+
+    o = numpy.zeros((m, n), dtype=numpy.complex128)
+    # a chunk of a mesh point holds Ex and Ey of a, and Hx, Hy and their
+    # conjugates of b
+    chunks = list(_chunks(ex.shape[1], (2*m + 4*n)*16, max_bytes))
+    logger.debug('%s by %s overlaps in %s chunks', m, n, len(chunks))
+    for s in chunks:
+        o += numpy.dot(ex[:, s], hy[:, s].conj().T)
+        o -= numpy.dot(ey[:, s], hx[:, s].conj().T)
+    o *= 0.5*dx*dy
+
+    if normalized:
+        pa = numpy.atleast_1d(power(a, max_bytes))
+        pb = pa if b is a else numpy.atleast_1d(power(b, max_bytes))
+        o /= numpy.sqrt(numpy.outer(pa, pb))
+    return o
+
+
+def effective_area(fields, max_bytes=MAX_BYTES):
+    """the effective area of each mode, (integral |E|^2)^2 / integral |E|^4
+
+    |E|^2 sums the squares of the transverse components, and of Ez if it is
+    in fields. Returns an array with an element per mode, or a float for a
+    single mode."""
+    dx, dy = grid_step(fields)
+    comps = [_stack(fields, c) for c in ('Ex', 'Ey', 'Ez') if c in fields]
+    n, npoints = comps[0].shape
+
+    area = numpy.empty(n)
+    for s in _chunks(n, (len(comps) + 2)*8*npoints, max_bytes):
+        e2 = sum(numpy.abs(c[s])**2 for c in comps)
+        area[s] = dx*dy*e2.sum(axis=1)**2/(e2**2).sum(axis=1)
+    return area if fields['Ex'].ndim == 3 else area[0]
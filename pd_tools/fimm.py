@@ -1,6 +1,21 @@
 """convenience functions for fimmwave"""
+import collections
+import json
+import logging
+import mmap
+import multiprocessing
+import os
 import numpy
+import numpy.lib.format
 import re
+import tempfile
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+logger = logging.getLogger(__name__)
 
 def add_vars(node, idx, name, var_dict):
     node.addsubnode('pdVariablesNode', name)
@@ -112,7 +127,8 @@ def add_device(node, idx, name, elspecs):
 
     return dev
 
-def load_amf(path):
+def _read_amf_header(f):
+    """reads the header of an AMF file, returning its fields as strings"""
     # pattern for generic floating-point number, and generic integer
     float_p = r'[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?'
     int_p = r'[-+]?\d+'
@@ -125,105 +141,387 @@ def load_amf(path):
         for k,v in m.groupdict().items():
             results[k] = v
 
-    with open(path, 'r') as f:
+    # read first line
+    assert f.readline().startswith('begin')
+
+    # second line, matrix dimensions
+    append_to_results(re.search(
+        r'''(?P<nx>{ui})\s+
+            (?P<ny>{ui})\s+
+            //nxseg\ nyseg'''.format(ui=uint_p),
+        f.readline(),
+        re.X))
+
+    # third line, physical dimensions
+    append_to_results(re.search(
+        r'''(?P<xmin>{f})\s+
+            (?P<xmax>{f})\s+
+            (?P<ymin>{f})\s+
+            (?P<ymax>{f})\s+
+            //xmin\ xmax\ ymin\ ymax'''.format(f=float_p),
+        f.readline(),
+        re.X))
+
+    # fourth line, field components included
+    append_to_results(re.search(
+        r'''(?P<hasEX>{b})\s+
+            (?P<hasEY>{b})\s+
+            (?P<hasEZ>{b})\s+
+            (?P<hasHX>{b})\s+
+            (?P<hasHY>{b})\s+
+            (?P<hasHZ>{b})\s+
+            //hasEX\ hasEY\ hasEZ\ hasHX\ hasHY\ hasHZ'''.format(b=bool_p),
+        f.readline(),
+        re.X))
+
+    # fifth line, propagation constant
+    append_to_results(re.search(
+        r'''(?P<beta_r>{f})\s+
+            (?P<beta_i>{f})\s+
+            //beta'''.format(f=float_p),
+        f.readline(),
+        re.X))
+
+    # sixth line, wavelength
+    append_to_results(re.search(
+        r'''(?P<lambda>{f})\s+
+            //lambda'''.format(f=float_p),
+        f.readline(),
+        re.X))
+
+    # seventh line, iscomplex
+    append_to_results(re.search(
+        r'''(?P<iscomplex>{b})\s+
+            //iscomplex'''.format(b=bool_p),
+        f.readline(),
+        re.X))
+
+    # eigth line, isWGmode
+    append_to_results(re.search(
+        r'''(?P<isWGmode>{b})\s+
+            //isWGmode'''.format(b=bool_p),
+        f.readline(),
+        re.X))
+
+    # ninth line
+    assert '//components follow as nyseg by nxseg matrices' in f.readline()
+
+    return results
+
+
+def _amf_blocks(f):
+    """yields the name and the lines of each component block of an AMF file"""
+    header_re = re.compile(r'\s+//(?P<n>\w+) components')
+    comp = None
+    lines = []
+    for line in iter(f.readline, ''):
+        hm = header_re.match(line)
+        if hm is not None or line.startswith('end'):
+            if comp is not None:
+                yield comp, lines
+            if hm is None:
+                return
+            comp = hm.group('n')
+            lines = []
+        else:
+            assert comp is not None
+            lines.append(line)
+    if comp is not None:
+        yield comp, lines
+
+
+def _parse_amf_block(text, nlines, nx, ny):
+    """parses the nlines lines of a component block into an array
+
+    The values are parsed in bulk by numpy. There are (nx+1)*(ny+1) of them
+    for a real component, and twice that for a complex one, whose real and
+    imaginary parts interleave, and which is then viewed as complex. Each
+    line is a column of the (ny+1, nx+1) result."""
+    values = numpy.fromstring(text, sep=' ')
+    n = (nx + 1)*(ny + 1)
+    if values.size == 2*n:
+        values = values.view(numpy.complex128)
+    elif values.size != n:
+        raise ValueError('expected %s or %s values, found %s' % (
+            n, 2*n, values.size))
+    return values.reshape(nlines, -1).transpose()
+
+
+def load_amf(path, cache=False):
+    """loads a mode field exported by fimmwave as an AMF file
+
+    Returns a dict of the fields of the header, as strings, and of an array
+    for each field component in the file, e.g. results['Ex'].
+
+    With cache, the parsed file is also saved to a sidecar directory next to
+    it (see amf_sidecar). Later loads of the same file return read-only
+    numpy.memmap arrays from the sidecar, without parsing the file again.
+    The sidecar is ignored if the size or mtime of the file changed."""
+    if cache:
+        results = _load_amf_sidecar(path)
+        if results is not None:
+            return results
 
+    with open(path, 'r') as f:
+        results = _read_amf_header(f)
+        nx, ny = int(results['nx']), int(results['ny'])
+        for comp, lines in _amf_blocks(f):
+            results[comp] = _parse_amf_block(''.join(lines), len(lines),
+                    nx, ny)
+
+    if cache:
+        try:
+            _save_amf_sidecar(path, results)
+        except (IOError, OSError) as e:
+            logger.warn('could not save sidecar of %s: %s', path, e)
+    return results
+
+
+def amf_sidecar(path):
+    """the sidecar directory of an AMF file
+
+    It holds a .npy file per component, and header.json with the header
+    fields, the names of the components, and the size and mtime of the AMF
+    file they were parsed from."""
+    return path + '.npy.d'
+
+
+def _load_amf_sidecar(path):
+    """returns the contents of a valid sidecar, or None"""
+    sidecar = amf_sidecar(path)
+    try:
+        with open(os.path.join(sidecar, 'header.json')) as f:
+            header = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    st = os.stat(path)
+    if header['source_size'] != st.st_size or (
+            header['source_mtime'] != st.st_mtime):
+        logger.debug('stale sidecar for %s', path)
+        return None
+
+    results = dict((str(k), str(v)) for k, v in header['fields'].items())
+    for comp in header['components']:
+        results[str(comp)] = numpy.load(
+            os.path.join(sidecar, comp + '.npy'), mmap_mode='r')
+    return results
+
+
+def _save_amf_sidecar(path, results):
+    sidecar = amf_sidecar(path)
+    if not os.path.isdir(sidecar):
+        os.makedirs(sidecar)
+
+    # header.json goes last, so that a sidecar is only valid once complete
+    header_path = os.path.join(sidecar, 'header.json')
+    if os.path.exists(header_path):
+        os.remove(header_path)
+
+    st = os.stat(path)
+    header = {
+        'source_size': st.st_size,
+        'source_mtime': st.st_mtime,
+        'fields': {},
+        'components': [],
+    }
+    for key, value in results.items():
+        if isinstance(value, numpy.ndarray):
+            numpy.save(os.path.join(sidecar, key + '.npy'), value)
+            header['components'].append(key)
+        else:
+            header['fields'][key] = value
 
-        # read first line
-        assert f.readline().startswith('begin')
-
-        # second line, matrix dimensions
-        append_to_results(re.search(
-            r'''(?P<nx>{ui})\s+
-                (?P<ny>{ui})\s+
-                //nxseg\ nyseg'''.format(ui=uint_p),
-            f.readline(),
-            re.X))
-
-        # third line, physical dimensions
-        append_to_results(re.search(
-            r'''(?P<xmin>{f})\s+
-                (?P<xmax>{f})\s+
-                (?P<ymin>{f})\s+
-                (?P<ymax>{f})\s+
-                //xmin\ xmax\ ymin\ ymax'''.format(f=float_p),
-            f.readline(),
-            re.X))
-
-        # fourth line, field components included
-        append_to_results(re.search(
-            r'''(?P<hasEX>{b})\s+
-                (?P<hasEY>{b})\s+
-                (?P<hasEZ>{b})\s+
-                (?P<hasHX>{b})\s+
-                (?P<hasHY>{b})\s+
-                (?P<hasHZ>{b})\s+
-                //hasEX\ hasEY\ hasEZ\ hasHX\ hasHY\ hasHZ'''.format(b=bool_p),
-            f.readline(),
-            re.X))
-
-        # fifth line, propagation constant
-        append_to_results(re.search(
-            r'''(?P<beta_r>{f})\s+
-                (?P<beta_i>{f})\s+
-                //beta'''.format(f=float_p),
-            f.readline(),
-            re.X))
-
-        # sixth line, wavelength
-        append_to_results(re.search(
-            r'''(?P<lambda>{f})\s+
-                //lambda'''.format(f=float_p),
-            f.readline(),
-            re.X))
-
-        # seventh line, iscomplex
-        append_to_results(re.search(
-            r'''(?P<iscomplex>{b})\s+
-                //iscomplex'''.format(b=bool_p),
-            f.readline(),
-            re.X))
-
-        # eigth line, isWGmode
-        append_to_results(re.search(
-            r'''(?P<isWGmode>{b})\s+
-                //isWGmode'''.format(b=bool_p),
-            f.readline(),
-            re.X))
-
-        # ninth line
-        assert '//components follow as nyseg by nxseg matrices' in f.readline()
-
-        # data
-
-        iscomplex = results['iscomplex']
+    tmp = header_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(header, f, sort_keys=True)
+    os.rename(tmp, header_path)
 
-        header_re = re.compile(r'\s+//(?P<n>\w+) components')
-        split_re = re.compile(r'\s+')
-        curr_comp = None
-        curr_data = None
-        for line in iter(f.readline, ''):
-            hm = header_re.match(line)
-            if hm is not None:
-                if curr_data is not None:
-                    results[curr_comp] = numpy.array(curr_data).transpose()
-
-                curr_data = []
-                curr_comp = hm.groupdict()['n']
-            elif line.startswith('end'):
-                if curr_data is not None:
-                    results[curr_comp] = numpy.array(curr_data).transpose()
-
-                break
-            else:
-                assert curr_data is not None
-                assert curr_comp is not None
 
-                data = map(float, split_re.split(line.strip()))
-                if iscomplex:
-                    data = [complex(*pair) for pair in
-                            numpy.reshape(data, (len(data)/2,2))]
-                curr_data.append(data)
+class LazyAMF(Mapping):
+    """an AMF file whose components are parsed when first accessed
 
-        return results
+    Scans the file once to index where each component block lies, and
+    parses the header right away. Holds the same keys as the dict returned
+    by load_amf. Parsed components are kept, up to max_bytes of them if
+    given, dropping the least recently used first."""
 
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._arrays = collections.OrderedDict()
+        self.nbytes = 0
 
+        header_re = re.compile(r'\s+//(?P<n>\w+) components')
+        # component name -> (offset, end offset)
+        self.index = collections.OrderedDict()
+        with open(path, 'r') as f:
+            self.header = _read_amf_header(f)
+            pos = f.tell()
+            # the data has no '//', so find jumps from header to header
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                comp = None
+                while True:
+                    i = m.find(b'//', pos)
+                    if i == -1:
+                        break
+                    start = m.rfind(b'\n', 0, i) + 1
+                    pos = m.find(b'\n', i) + 1 or len(m)
+                    hm = header_re.match(m[start:pos].decode('ascii'))
+                    if hm is None:
+                        continue
+                    if comp is not None:
+                        self.index[comp] = (self.index[comp], start)
+                    comp = hm.group('n')
+                    self.index[comp] = pos
+                if comp is not None:
+                    end = m.find(b'\nend', self.index[comp] - 1)
+                    self.index[comp] = (self.index[comp],
+                            len(m) if end == -1 else end + 1)
+            finally:
+                m.close()
+        self.nx, self.ny = int(self.header['nx']), int(self.header['ny'])
+
+    @property
+    def components(self):
+        return list(self.index)
+
+    def __getitem__(self, key):
+        if key in self.header:
+            return self.header[key]
+        if key not in self.index:
+            raise KeyError(key)
+
+        if key in self._arrays:
+            # most recently used last
+            array = self._arrays.pop(key)
+        else:
+            array = self._parse(key)
+            self.nbytes += array.nbytes
+        self._arrays[key] = array
+        self._evict()
+        return array
+
+    def _parse(self, comp):
+        start, end = self.index[comp]
+        # binary, as the offsets are in bytes whatever the line endings
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            text = f.read(end - start)
+        logger.debug('parsing %s of %s', comp, self.path)
+        return _parse_amf_block(text, text.count(b'\n'), self.nx, self.ny)
+
+    def _evict(self):
+        """drops parsed components, except the last used, down to max_bytes"""
+        while (self.max_bytes is not None and self.nbytes > self.max_bytes
+                and len(self._arrays) > 1):
+            comp, array = self._arrays.popitem(last=False)
+            self.nbytes -= array.nbytes
+
+    def __iter__(self):
+        for key in self.header:
+            yield key
+        for comp in self.index:
+            yield comp
+
+    def __len__(self):
+        return len(self.header) + len(self.index)
+
+    def __repr__(self):
+        return '<LazyAMF {path} {comps}>'.format(
+            path=self.path, comps=','.join(self.index))
+
+
+AMF_META_DTYPE = numpy.dtype([
+    ('nx', 'i4'),
+    ('ny', 'i4'),
+    ('xmin', 'f8'),
+    ('xmax', 'f8'),
+    ('ymin', 'f8'),
+    ('ymax', 'f8'),
+    ('beta', 'c16'),
+    ('lambda', 'f8'),
+    ('isWGmode', '?'),
+])
+
+
+def _amf_meta(header):
+    return (int(header['nx']), int(header['ny']),
+            float(header['xmin']), float(header['xmax']),
+            float(header['ymin']), float(header['ymax']),
+            complex(float(header['beta_r']), float(header['beta_i'])),
+            float(header['lambda']), header['isWGmode'] == '1')
+
+
+def load_amf_many(paths, components=('Ex', 'Ey', 'Hx', 'Hy'), workers=None,
+        directory=None):
+    """loads many AMF files of the same mesh into stacked arrays
+
+    Returns a dict of an array of shape (len(paths), nyseg+1, nxseg+1) for
+    each of the components, and a structured array of the header values of
+    each file (see AMF_META_DTYPE). The arrays are numpy.memmaps of .npy
+    files in directory, a new temporary directory by default, which also
+    gets the header values as meta.npy.
+
+    The files are parsed by a pool of workers processes, all of them by
+    default, each writing its components straight into the memmaps. With
+    workers=1 they are parsed in this process. On Windows, call it from
+    under `if __name__ == '__main__'`."""
+    paths = list(paths)
+    if not paths:
+        raise ValueError('no paths')
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='amf-')
+    elif not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    meta = numpy.zeros(len(paths), dtype=AMF_META_DTYPE)
+    for i, path in enumerate(paths):
+        with open(path, 'r') as f:
+            meta[i] = _amf_meta(_read_amf_header(f))
+    nx, ny = int(meta['nx'][0]), int(meta['ny'][0])
+    for i in numpy.flatnonzero((meta['nx'] != nx) | (meta['ny'] != ny)):
+        raise ValueError('%s is not a %s by %s mesh' % (paths[i], nx, ny))
+    numpy.save(os.path.join(directory, 'meta.npy'), meta)
+
+    shape = (len(paths), ny + 1, nx + 1)
+    for comp in components:
+        numpy.lib.format.open_memmap(os.path.join(directory, comp + '.npy'),
+                mode='w+', dtype=numpy.complex128, shape=shape).flush()
+
+    tasks = [(i, path, components, directory)
+            for i, path in enumerate(paths)]
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1:
+        for task in tasks:
+            _ingest_amf(task)
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            # only the indices come back through the pipe
+            for i in pool.imap_unordered(_ingest_amf, tasks,
+                    chunksize=max(1, len(tasks)//(8*workers))):
+                logger.debug('loaded %s', paths[i])
+        finally:
+            pool.close()
+            pool.join()
+
+    arrays = dict((comp, numpy.load(os.path.join(directory, comp + '.npy'),
+        mmap_mode='r+')) for comp in components)
+    arrays['meta'] = meta
+    return arrays
+
+
+def _ingest_amf(task):
+    """parses the components of one file into their stacked memmaps"""
+    i, path, components, directory = task
+    # keeps no more than the component being copied
+    amf = LazyAMF(path, max_bytes=0)
+    for comp in components:
+        stack = numpy.load(os.path.join(directory, comp + '.npy'),
+                mmap_mode='r+')
+        stack[i] = amf[comp]
+        stack.flush()
+        del stack
+    return i
@@ -0,0 +1,200 @@
+"""timing of the messages a PDApp exchanges with fimmwave
+
+Set a Recorder on a connection to have every exchange timed:
+
+    connection = pd_tools.PDApp(host='localhost', port=5101,
+            recorder=Recorder([Summary(), JSONLines('timings.jsonl')]))
+    ...
+    print(connection.recorder.exporters[0].report())
+
+Each exchange gives a sample, a dict with the kind of command ('help', 'get',
+'set', 'call', 'flush' for a batch, or 'lost' for an exchange that got no
+reply), the number of commands and the bytes sent and received, and the
+seconds spent sending, waiting for the server to answer, receiving the reply
+and decoding it. Samples are handed to each exporter of the recorder. Without
+a recorder, nothing is timed.
+"""
+import collections
+import json
+import logging
+import time
+
+from .batch import _assignpat, _bindpat, _callpat
+
+__all__ = ['Recorder', 'Summary', 'Histogram', 'JSONLines', 'Callback',
+        'command_kind']
+logger = logging.getLogger(__name__)
+
+# the best clock available
+timer = getattr(time, 'perf_counter', time.time)
+
+PHASES = ('send', 'wait', 'recv', 'decode')
+
+
+def command_kind(cmd):
+    """classifies a command as 'help', 'set', 'call' or 'get'"""
+    if cmd.lstrip().startswith('help '):
+        return 'help'
+    elif _assignpat.match(cmd) or _bindpat.match(cmd):
+        return 'set'
+    elif _callpat.match(cmd):
+        return 'call'
+    else:
+        return 'get'
+
+
+class Recorder(object):
+    """hands the samples of a connection to its exporters
+
+    The exporters default to a single Summary."""
+
+    def __init__(self, exporters=None):
+        if exporters is None:
+            exporters = [Summary()]
+        self.exporters = list(exporters)
+
+    def record(self, sample):
+        for exporter in self.exporters:
+            try:
+                exporter.export(sample)
+            except Exception:
+                logger.exception('exporter %s failed', exporter)
+
+    def close(self):
+        for exporter in self.exporters:
+            exporter.close()
+
+
+class Histogram(object):
+    """latency histogram with a bounded relative error, in the style of HDR
+
+    Values are counted in microseconds, in buckets whose width is a power of
+    two no larger than 1/2**(significant_bits - 1) of their lower bound. Only
+    buckets in use are stored."""
+
+    def __init__(self, significant_bits=6):
+        self.significant_bits = significant_bits
+        self.counts = collections.defaultdict(int)
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.total = 0.
+
+    def _key(self, us):
+        shift = max(us.bit_length() - self.significant_bits, 0)
+        return shift, us >> shift
+
+    def record(self, seconds):
+        us = max(int(seconds*1e6), 0)
+        self.counts[self._key(us)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """the value below which p percent of the values lie, in seconds"""
+        if not self.count:
+            return None
+        rank = p/100.*self.count
+        seen = 0
+        for shift, mantissa in sorted(self.counts,
+                key=lambda k: k[1] << k[0]):
+            seen += self.counts[shift, mantissa]
+            if seen >= rank:
+                # the middle of the bucket
+                us = (mantissa << shift) + ((1 << shift) - 1)/2.
+                return min(max(us/1e6, self.min), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total/self.count if self.count else None
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean(),
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class Summary(object):
+    """in-memory totals and latency histograms, by kind of command"""
+
+    def __init__(self, significant_bits=6):
+        self.significant_bits = significant_bits
+        self.kinds = {}
+
+    def export(self, sample):
+        kind = self.kinds.get(sample['kind'])
+        if kind is None:
+            kind = self.kinds[sample['kind']] = {
+                'count': 0,
+                'cmds': 0,
+                'bytes_sent': 0,
+                'bytes_recv': 0,
+                'latency': Histogram(self.significant_bits),
+            }
+            kind.update(dict.fromkeys(PHASES, 0.))
+
+        kind['count'] += 1
+        for key in ('cmds', 'bytes_sent', 'bytes_recv') + PHASES:
+            kind[key] += sample[key]
+        kind['latency'].record(sample['total'])
+
+    def to_dict(self):
+        summary = {}
+        for name, kind in self.kinds.items():
+            summary[name] = dict(kind, latency=kind['latency'].to_dict())
+        return summary
+
+    def report(self):
+        """a table of the totals by kind, as a string"""
+        lines = ['%-6s %7s %10s %10s %9s %9s %9s %9s %9s %9s' % (
+            'kind', 'count', 'sent', 'received', 'send', 'wait', 'recv',
+            'decode', 'p50', 'p99')]
+        for name in sorted(self.kinds):
+            kind = self.kinds[name]
+            lines.append('%-6s %7d %10d %10d %9.4f %9.4f %9.4f %9.4f %9.6f '
+                    '%9.6f' % ((name, kind['count'], kind['bytes_sent'],
+                    kind['bytes_recv']) + tuple(kind[p] for p in PHASES) + (
+                    kind['latency'].percentile(50),
+                    kind['latency'].percentile(99))))
+        return '\n'.join(lines)
+
+    def close(self):
+        pass
+
+
+class JSONLines(object):
+    """appends each sample to a file, as a line of JSON"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        # line buffered, so that the file is complete after a crash
+        self._file = open(filename, 'a', 1)
+
+    def export(self, sample):
+        self._file.write(json.dumps(sample, sort_keys=True) + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+class Callback(object):
+    """calls a function with each sample"""
+
+    def __init__(self, func):
+        self.func = func
+
+    def export(self, sample):
+        self.func(sample)
+
+    def close(self):
+        pass
@@ -0,0 +1,203 @@
+"""memoization of solves, keyed by a hash of everything that goes into them
+
+    store = MemoStore('memo', max_bytes=1e9)
+    state = {
+        'variables': base_variables,  # as given to fimm.add_vars
+        'waveguide': slice_specs,     # as given to fimm.add_rwg
+        'mlp': mlp, 'svp': svp,       # as given to fimm.config_solver
+    }
+    sweep = Sweep(axes, memoized(solve, store, state), 'results.jsonl')
+
+The results of solve are kept in the store under a hash of the namespace of
+solve, the state and the point. Points that were solved before, by any sweep
+with the same solve function and state, are answered from the store without
+touching fimmwave. The state must hold every input the solve depends on, or
+stale results will be returned.
+
+The namespace defaults to the module and name of solve. Lambdas, closures
+and other callables without a name of their own need an explicit namespace,
+which must change whenever what they return does:
+
+    memoized(lambda app, point: ..., store, state, namespace='neffg')
+"""
+import hashlib
+import json
+import logging
+import numbers
+import os
+import threading
+import time
+
+import numpy
+
+from .sweep import _dumps, _from_json
+
+__all__ = ['MemoStore', 'memoized', 'state_hash']
+logger = logging.getLogger(__name__)
+
+
+def _canonical(obj):
+    """a form of obj that serializes the same for equal inputs
+
+    Floats are rounded to 12 significant digits, so that 1.1 and
+    numpy.arange(1, 2, 0.1)[1] are the same input."""
+    if isinstance(obj, dict):
+        return dict((str(k), _canonical(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, numpy.ndarray)):
+        return [_canonical(v) for v in obj]
+    elif isinstance(obj, numpy.generic):
+        return _canonical(obj.item())
+    elif isinstance(obj, bool) or obj is None:
+        return obj
+    elif isinstance(obj, numbers.Integral):
+        return int(obj)
+    elif isinstance(obj, numbers.Real):
+        return float('%.12g' % obj)
+    elif isinstance(obj, numbers.Complex):
+        return [_canonical(obj.real), _canonical(obj.imag)]
+    return obj
+
+
+def state_hash(*parts):
+    """the hex digest of the canonical JSON of parts"""
+    return hashlib.sha1(_dumps(_canonical(list(parts))).encode(
+        'utf-8')).hexdigest()
+
+
+class MemoStore(object):
+    """a directory of results, each in a file named by its key
+
+    Files are spread over subdirectories by the first two characters of
+    their key. With max_bytes, the least recently used files are deleted
+    once the store grows beyond it. Hits and misses are counted in
+    `stats`."""
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = dict.fromkeys(('hits', 'misses', 'evictions'), 0)
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.nbytes = sum(os.path.getsize(path) for path in self._files())
+
+    def _files(self):
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.json'):
+                    yield os.path.join(root, name)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                value = json.load(f, object_hook=_from_json)
+        except (IOError, OSError, ValueError):
+            self.stats['misses'] += 1
+            return default
+        # mark it recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.stats['hits'] += 1
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        data = _dumps(value)
+        with self._lock:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            old = os.path.getsize(path) if os.path.exists(path) else 0
+
+            # write and rename, so that readers never see half a file
+            tmp = '%s.%s.tmp' % (path, threading.current_thread().ident)
+            with open(tmp, 'w') as f:
+                f.write(data)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp, path)
+
+            self.nbytes += len(data) - old
+            if self.max_bytes is not None and self.nbytes > self.max_bytes:
+                self._evict(keep=path)
+
+    def _evict(self, keep=None):
+        """deletes the least recently used files down to max_bytes"""
+        files = sorted((os.path.getmtime(path), path) for path in self._files()
+                if path != keep)
+        for mtime, path in files:
+            if self.nbytes <= self.max_bytes:
+                break
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.nbytes -= size
+            self.stats['evictions'] += 1
+            logger.debug('evicted %s', path)
+
+    def clear(self):
+        with self._lock:
+            for path in list(self._files()):
+                os.remove(path)
+            self.nbytes = 0
+
+
+# marks a result missing from the store
+_missing = object()
+
+
+def _namespace(func):
+    """the module and name of a function, if they identify it"""
+    name = getattr(func, '__name__', None)
+    if (name is None or name == '<lambda>' or
+            getattr(func, '__closure__', None) is not None):
+        raise ValueError('memoizing %s needs a namespace' % repr(func))
+    return '%s.%s' % (func.__module__, name)
+
+
+def memoized(func, store, state, namespace=None):
+    """wraps a sweep function func(app, point) to go through a MemoStore
+
+    state holds the inputs of the solve besides the point, and namespace
+    tells func apart from other functions that share the store, see the
+    module docstring.
+
+    The wrapper also has lookup(point), which returns the stored result or
+    raises KeyError, and compute(app, point), which solves and stores
+    without looking. A Sweep uses them to skip its setters on a hit."""
+    if namespace is None:
+        namespace = _namespace(func)
+
+    def lookup(point):
+        result = store.get(state_hash(namespace, state, point), _missing)
+        if result is _missing:
+            raise KeyError(point)
+        logger.debug('memo hit for %s', point)
+        return result
+
+    def compute(app, point):
+        start = time.time()
+        result = func(app, point)
+        logger.debug('solved %s in %.1f s', point, time.time() - start)
+        store.put(state_hash(namespace, state, point), result)
+        return result
+
+    def solve(app, point):
+        try:
+            return lookup(point)
+        except KeyError:
+            return compute(app, point)
+
+    solve.__name__ = getattr(func, '__name__', 'memoized')
+    solve.__doc__ = func.__doc__
+    solve.lookup = lookup
+    solve.compute = compute
+    return solve
+
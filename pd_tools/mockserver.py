@@ -0,0 +1,437 @@
+"""A stand-in for fimmwave's TCP command server
+
+Listens on a TCP port and speaks the framing used by pdApp.Exec, answering
+commands from a scriptable tree of MockNodes. Useful for benchmarking and
+exercising the client on machines without fimmwave.
+
+    tree = demo_tree()
+    with MockServer(tree, latency=0.001) as server:
+        connection = pd_tools.PDApp(host='localhost', port=server.port)
+        with connection as app:
+            print(app.subnodes[1].evlist.list[1].neff())
+
+Supported commands are `help <path>`, reading `<path>`, assigning
+`<path>=<value>`, calling `<path>(<args>)` and binding variables with
+`Ref& <name>=<cmd>` or `Set <name>=<cmd>`, where cmd may also be a number.
+Unknown paths give an error message, like fimmwave does.
+
+Run as a script to serve demo_tree() on a port:
+
+    python -m pd_tools.mockserver --port 5101
+"""
+import argparse
+import logging
+import re
+import socket
+import threading
+import time
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+__all__ = ['MockNode', 'MockServer', 'demo_tree']
+logger = logging.getLogger(__name__)
+
+HEADER_SIZE = 20 # pdPythonLib.INTBUFFSIZE
+PRIMITIVE_TYPES = ('INTEGER', 'FLOAT', 'STRING', 'MATRIX<COMPLEX>')
+
+_tokenpat = re.compile(r'\.?(?P<name>[^.[\]]+)|\[(?P<idx>[^[\]]+)\]')
+_assignpat = re.compile(r'\A(?P<path>[^=(\s]+)\s*=(?P<value>.*)\Z', re.S)
+_callpat = re.compile(r'\A(?P<path>[^=(\s]+)\((?P<args>.*)\)\Z', re.S)
+_numpat = re.compile(r'\A[-+]?[\d.]+(?:[eE][-+]?\d+)?\Z')
+_bindpat = re.compile(r'\A(?P<kind>Ref&|Set)\s+(?P<name>\w+)\s*=(?P<cmd>.*)\Z',
+        re.S)
+
+
+class MockError(Exception):
+    pass
+
+
+class MockNode(object):
+    """a node in the mock tree
+
+    Primitives (see PRIMITIVE_TYPES) hold a `value`. FUNCTION nodes hold
+    `func`, which is called with the converted arguments. LIST nodes hold
+    their elements in `items`, indexed from 1. Any other nodetype is a plain
+    node whose `children` are looked up by name.
+    """
+
+    def __init__(self, nodetype, value=None, func=None, items=None,
+            description=''):
+        self.nodetype = nodetype
+        self.value = value
+        self.func = func
+        self.items = items if items is not None else []
+        self.children = {}
+        self.description = description
+
+    def add(self, name, node):
+        """adds a child and returns it"""
+        self.children[name] = node
+        return node
+
+    def child(self, key):
+        if self.nodetype.startswith('LIST'):
+            try:
+                idx = int(key)
+                if idx < 1:
+                    raise IndexError
+                return self.items[idx - 1]
+            except (ValueError, IndexError):
+                raise MockError('invalid index %s' % key)
+        try:
+            return self.children[key]
+        except KeyError:
+            raise MockError('%s is not a child' % key)
+
+
+def _is_matrix(value):
+    return isinstance(value, (list, tuple)) or hasattr(value, 'shape')
+
+
+def _format_value(value):
+    if isinstance(value, complex):
+        return '(%r,%r)' % (value.real, value.imag)
+    elif isinstance(value, float):
+        return repr(value)
+    else:
+        return '%s' % value
+
+
+def _format_matrix(label, value):
+    """formats a 1d or 2d sequence as 'label[i][j] value' lines"""
+    lines = []
+    for i, row in enumerate(value, 1):
+        if _is_matrix(row):
+            for j, element in enumerate(row, 1):
+                lines.append('  {l}[{i}][{j}] {v}'.format(
+                    l=label, i=i, j=j, v=_format_value(element)))
+        else:
+            lines.append('  {l}[{i}] {v}'.format(
+                l=label, i=i, v=_format_value(row)))
+    return '\n'.join(lines)
+
+
+def _convert_arg(arg):
+    """converts a command argument to a number if possible"""
+    arg = arg.strip()
+    if len(arg) > 1 and arg[0] == arg[-1] and arg[0] in '"\'':
+        return arg[1:-1]
+    for convert in (int, float):
+        try:
+            return convert(arg)
+        except ValueError:
+            pass
+    return arg
+
+
+def _split_top(string, sep):
+    """splits on sep, except inside quotes, parentheses or brackets"""
+    parts = []
+    depth = 0
+    quote = None
+    start = 0
+    for i, c in enumerate(string):
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in '"\'':
+            quote = c
+        elif c in '([':
+            depth += 1
+        elif c in ')]':
+            depth -= 1
+        elif c == sep and depth == 0:
+            parts.append(string[start:i])
+            start = i + 1
+    parts.append(string[start:])
+    return parts
+
+
+class MockServer(object):
+    """serves a tree of MockNodes over the fimmwave protocol
+
+    `latency` is slept before every reply, and `bandwidth` (in bytes/s)
+    throttles sending the reply. `port=0` picks a free port, available as
+    `port` once the server is started."""
+
+    def __init__(self, root, host='localhost', port=0, latency=0.0,
+            bandwidth=None, chunk_size=65536):
+        self.root = root
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.chunk_size = chunk_size
+        self.variables = {}
+        self.messages = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        """starts serving in a background thread, returns the port"""
+        mock = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                try:
+                    mock._handle(self.request)
+                except socket.error as e:
+                    logger.debug('client hung up: %s', e)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self._server = socketserver.ThreadingTCPServer(
+            (self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        logger.debug('mock server listening on port %s', self.port)
+        return self.port
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _handle(self, sock):
+        while True:
+            header = self._recv(sock, HEADER_SIZE)
+            if header is None:
+                return
+            msglen = int(header.decode('latin-1'))
+            msg = self._recv(sock, msglen)
+            if msg is None:
+                return
+
+            cmds = msg.decode('latin-1').rstrip('\0')
+            with self._lock:
+                self.messages += 1
+                reply = self.execute(cmds)
+
+            if self.latency:
+                time.sleep(self.latency)
+            reply = reply.encode('latin-1')
+            lenstr = repr(len(reply)).encode('latin-1')
+            self._send(sock,
+                    lenstr + b'\0'*(HEADER_SIZE - len(lenstr)) + reply)
+
+    def _recv(self, sock, msglen):
+        chunks = []
+        received = 0
+        while received < msglen:
+            chunk = sock.recv(msglen - received)
+            if not chunk:
+                return None
+            chunks.append(chunk)
+            received += len(chunk)
+        return b''.join(chunks)
+
+    def _send(self, sock, data):
+        if not self.bandwidth:
+            sock.sendall(data)
+            return
+        for i in range(0, len(data), self.chunk_size):
+            chunk = data[i:i + self.chunk_size]
+            sock.sendall(chunk)
+            time.sleep(float(len(chunk))/self.bandwidth)
+
+    def execute(self, cmds):
+        """runs a ';'-separated command string, returns the reply text"""
+        sections = []
+        for cmd in _split_top(cmds, ';'):
+            cmd = cmd.strip()
+            if not cmd:
+                continue
+            try:
+                result = self._execute(cmd)
+            except MockError as e:
+                sections.append('ERROR: %s: %s\n\0' % (cmd, e))
+                continue
+            if result is not None:
+                sections.append('RETVAL:%s\n\0' % result)
+        return ''.join(sections) or '\n\0'
+
+    def _execute(self, cmd):
+        if cmd.startswith('help '):
+            path = cmd[5:].strip()
+            return self._help(path, self._resolve(path))
+
+        m = _bindpat.match(cmd)
+        if m:
+            value = m.group('cmd').strip()
+            if _numpat.match(value):
+                node = MockNode('RESULT', value=_convert_arg(value))
+            else:
+                node = self._evaluate(value)
+            self.variables[m.group('name')] = node
+            return None
+
+        m = _assignpat.match(cmd)
+        if m:
+            node = self._resolve(m.group('path'))
+            if node.nodetype not in PRIMITIVE_TYPES:
+                raise MockError('cannot assign to a %s' % node.nodetype)
+            node.value = _convert_arg(m.group('value'))
+            return None
+
+        node = self._evaluate(cmd)
+        return self._format(cmd, node)
+
+    def _evaluate(self, cmd):
+        """returns the node a path refers to, or the result of a call"""
+        m = _callpat.match(cmd)
+        if m is None:
+            return self._resolve(cmd)
+
+        node = self._resolve(m.group('path'))
+        if node.nodetype != 'FUNCTION':
+            raise MockError('not a function')
+        args = [_convert_arg(arg) for arg in _split_top(m.group('args'), ',')
+                if arg.strip()]
+        result = node.func(*args)
+        if result is None or isinstance(result, MockNode):
+            return result
+        return MockNode('RESULT', value=result)
+
+    def _resolve(self, path):
+        tokens = [(m.group('name'), m.group('idx'))
+                for m in _tokenpat.finditer(path)]
+        if not tokens or tokens[0][0] is None:
+            raise MockError('invalid path %s' % path)
+
+        first = tokens[0][0]
+        if first == 'app':
+            node = self.root
+        elif first in self.variables:
+            node = self.variables[first]
+        else:
+            raise MockError('unknown variable %s' % first)
+
+        for name, idx in tokens[1:]:
+            node = node.child(name if idx is None else idx)
+        return node
+
+    def _label(self, path):
+        """the last name in a path, e.g. 'list' for 'app.list[2]'"""
+        return path.split('(')[0].rsplit('.', 1)[-1].split('[')[0]
+
+    def _help(self, path, node):
+        lines = ['{n} {t}'.format(n=self._label(path), t=node.nodetype)]
+        if node.children:
+            lines.append('Children:')
+            for name in sorted(node.children):
+                child = node.children[name]
+                line = '  {n} {t}'.format(n=name, t=child.nodetype)
+                if child.description:
+                    line += ' - ' + child.description
+                lines.append(line)
+        return '\n'.join(lines)
+
+    def _format(self, cmd, node):
+        if node is None:
+            return None
+        label = self._label(cmd)
+        if node.nodetype.startswith('LIST'):
+            if not node.items:
+                return '<EMPTY>'
+            return '\n'.join('  {l}[{i}] '.format(l=label, i=i)
+                    for i in range(1, len(node.items) + 1))
+        elif node.value is None:
+            return node.nodetype
+        elif _is_matrix(node.value):
+            return _format_matrix(label, node.value)
+        else:
+            return _format_value(node.value)
+
+
+def function(func, description=''):
+    return MockNode('FUNCTION', func=func, description=description)
+
+
+def demo_tree(nmodes=4, nx=16, ny=8):
+    """a small project with one waveguide and a list of nmodes modes
+
+    Each mode has neff(), a modedata node with tefrac/neffg, and an nx by ny
+    complex field. app.blob(n) returns an n byte string, for measuring
+    raw transfer rates. app.subnodes[2] is a variables node, whose w_core
+    variable shifts the real part of every neff by w_core/1000."""
+    app = MockNode('fimmwave_app')
+    app.add('version', MockNode('STRING', value='mock'))
+    app.add('exit', function(lambda: None))
+    app.add('blob', function(lambda n: 'x'*int(n),
+            'returns an n byte string'))
+
+    subnodes = app.add('subnodes', MockNode('LIST'))
+    app.add('addsubnode', function(
+        lambda nodetype, name: subnodes.items.append(MockNode(nodetype))))
+
+    wg = MockNode('rwguideNode')
+    subnodes.items.append(wg)
+    wg.add('width', MockNode('FLOAT', value=2.0))
+    evlist = wg.add('evlist', MockNode('EVLIST'))
+    mlp = evlist.add('mlp', MockNode('MLP'))
+    for name, value in (('nx', 512), ('ny', 192),
+            ('mintefrac', 0), ('maxtefrac', 100)):
+        mlp.add(name, MockNode('INTEGER', value=value))
+    evlist.add('update', function(lambda: None, 'solves for modes'))
+
+    variables = MockNode('pdVariablesNode')
+    subnodes.items.append(variables)
+    values = {}
+    variables.add('addvariable', function(
+        lambda name: values.setdefault(name, 0)))
+    variables.add('setvariable', function(
+        lambda name, value: values.__setitem__(name, value)))
+    variables.add('getvariable', function(lambda name: values[name]))
+
+    modes = evlist.add('list', MockNode('LIST'))
+    for i in range(nmodes):
+        mode = MockNode('EVDATA')
+        mode.add('neff', function(lambda i=i: complex(
+            1.6 - 0.01*i + 0.001*float(values.get('w_core', 0)), 1e-7*i)))
+        modedata = mode.add('modedata', MockNode('MODEDATA'))
+        modedata.add('tefrac', MockNode('FLOAT', value=100.0 - 10*i))
+        modedata.add('neffg', MockNode('FLOAT', value=1.9 + 0.01*i))
+        modedata.add('update', function(lambda *args: None))
+        mode.add('field', MockNode('MATRIX<COMPLEX>', value=[
+            [complex(x, y) for y in range(ny)] for x in range(nx)]))
+        modes.items.append(mode)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='mock fimmwave server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5101)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--bandwidth', type=float, default=None)
+    args = parser.parse_args()
+
+    server = MockServer(demo_tree(), args.host, args.port,
+            latency=args.latency, bandwidth=args.bandwidth)
+    server.start()
+    print('serving on %s:%s, ctrl-c to stop' % (args.host, server.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -103,7 +103,7 @@ def InterpretString(commStr,varList):
             commStr2 = commStr2 + InterpretString1(commStr1,varList)
             currIdx = find(commStr,'"',nextIdx+1) #Must have open quotes and end quotes!!!
             if (currIdx==-1):
-                print "Error interpreting command\n"
+                print("Error interpreting command\n")
                 return commStr
             commStr2 = commStr2 + commStr[nextIdx:currIdx+1]
             currIdx = currIdx + 1
@@ -242,16 +242,16 @@ class pdApp:
                 
         self.appSock = socket(AF_INET,SOCK_STREAM)
         a = 0
-        print "Attempting to connect to application on TCP/IP Port No. " + repr(portNo)
+        print("Attempting to connect to application on TCP/IP Port No. " + repr(portNo))
         while (a<CONNECTIONATTEMPTS):
             try:
                 self.appSock.connect((hostname,portNo))
                 break
             except:
                 a = a + 1
-                print "Connection Attempt Number " + repr(a)
+                print("Connection Attempt Number " + repr(a))
                 if (a==CONNECTIONATTEMPTS):
-                    print "WARNING: Failed to connect to the application\n"
+                    print("WARNING: Failed to connect to the application\n")
                     return retstr + "Failed to connect to the application\n"
         portsTaken.append(portNo)
         self.currPort = portNo
@@ -304,12 +304,12 @@ class pdApp:
             recmsg = self.appSock.recv(recmsglen)
         #now test to see what has been returned
         if (len(recmsg)<recmsglen): # part of the message is missing
-            print "================================================================="
-            print "WARNING: some of the data sent by the application has not been received."
-            print "Please reduce 'MaxBuffSize' or increase 'delay' in pdPythonLib.py"
-            print "and try to run the script again."
-            print "If the problem remains please contact Photon Design."
-            print "================================================================="
+            print("=================================================================")
+            print("WARNING: some of the data sent by the application has not been received.")
+            print("Please reduce 'MaxBuffSize' or increase 'delay' in pdPythonLib.py")
+            print("and try to run the script again.")
+            print("If the problem remains please contact Photon Design.")
+            print("=================================================================")
             raw_input("Press Enter to continue")
         retvalcount = count(recmsg,"RETVAL:")
         if retvalcount==0: #if no RETVAL, return what was returned (usually an error message)
@@ -0,0 +1,204 @@
+"""finds the lines of a script that cause the most round trips to fimmwave
+
+    from pd_tools.profile import Profiler
+
+    with Profiler() as prof:
+        for mode in wg.evlist.list:
+            print(mode.neff(), mode.modedata.tefrac)
+    print(prof.report())
+
+While profiling, every exchange of every PDApp is attributed to the line of
+user code (the innermost frame outside pd_tools) that caused it, along with
+the user frames that called it, up to depth frames in all. The same line
+reached from different callers makes different call sites. The report ranks
+the call sites by round trips, bytes or time, with suggestions on how to cut
+down their traffic.
+"""
+import linecache
+import logging
+import os
+import sys
+import threading
+
+from . import wrapper
+from .connection import PDApp
+from .instrument import command_kind, timer
+
+__all__ = ['Profiler']
+logger = logging.getLogger(__name__)
+
+_package_dir = os.path.dirname(os.path.abspath(__file__)) + os.sep
+
+KINDS = ('help', 'get', 'set', 'call', 'batch')
+SORT_KEYS = ('round_trips', 'bytes', 'time')
+
+# how many round trips from one line make a suggestion worthwhile
+SUGGEST_MIN = 10
+
+# how many frames of user code make a call site
+DEPTH = 4
+
+
+class Site(object):
+    """the traffic caused by one line of user code, from one stack of callers
+
+    stack holds the (filename, lineno, function) of the frames, innermost
+    first."""
+
+    __slots__ = ('stack', 'filename', 'lineno', 'function', 'round_trips',
+            'kinds', 'bytes_sent', 'bytes_recv', 'time')
+
+    def __init__(self, stack):
+        self.stack = stack
+        self.filename, self.lineno, self.function = stack[0]
+        self.round_trips = 0
+        self.kinds = dict.fromkeys(KINDS, 0)
+        self.bytes_sent = 0
+        self.bytes_recv = 0
+        self.time = 0.
+
+    @property
+    def bytes(self):
+        return self.bytes_sent + self.bytes_recv
+
+    def line(self):
+        return linecache.getline(self.filename, self.lineno).strip()
+
+    def suggestions(self):
+        tips = []
+        if self.kinds['help'] >= SUGGEST_MIN:
+            tips.append('%s help requests: pass infer_item_types or a '
+                    'schema_cache to PDApp, or iterate lists with '
+                    'iter_fields' % self.kinds['help'])
+        if self.kinds['get'] >= SUGGEST_MIN:
+            tips.append('%s reads: read several values at once with '
+                    'get_many or iter_fields, or pass a cache_size to PDApp'
+                    % self.kinds['get'])
+        if self.kinds['set'] + self.kinds['call'] >= SUGGEST_MIN:
+            tips.append('%s assignments and calls: queue them in batch mode'
+                    % (self.kinds['set'] + self.kinds['call']))
+        return tips
+
+    def __repr__(self):
+        return '<Site {f}:{l} {n} round trips>'.format(
+            f=self.filename, l=self.lineno, n=self.round_trips)
+
+
+def _call_site(frame, depth=DEPTH):
+    """the (filename, lineno, function) of up to depth frames outside
+    pd_tools, innermost first"""
+    stack = []
+    # callers may go through pd_tools again, e.g. a Sweep, so keep walking
+    while frame is not None and len(stack) < depth:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if not filename.startswith(_package_dir):
+            stack.append((filename, frame.f_lineno, frame.f_code.co_name))
+        frame = frame.f_back
+    return tuple(stack) or (('<unknown>', 0, '<unknown>'),)
+
+
+class Profiler(object):
+    """attributes the exchanges of all PDApps to lines of user code
+
+    Patches PDApp._exchange, through which every round trip goes, and
+    wrapper._init_node, to tell the help requests made to set up nodes.
+    Only one Profiler can be active at a time. depth is the number of user
+    frames that make a call site, 1 to attribute by line alone."""
+
+    _active = None
+
+    def __init__(self, depth=DEPTH):
+        if depth < 1:
+            raise ValueError('depth must be at least 1')
+        self.depth = depth
+        self.sites = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._saved = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        if Profiler._active is not None:
+            raise ValueError('already profiling')
+        Profiler._active = self
+        # the plain function, not the unbound method
+        self._saved = (PDApp.__dict__['_exchange'], wrapper._init_node)
+
+        exchange, init_node = self._saved
+        profiler = self
+
+        def _exchange(pd_app, cmds):
+            start = timer()
+            recmsg = exchange(pd_app, cmds)
+            profiler._record(cmds, recmsg, timer() - start)
+            return recmsg
+
+        def _init_node(node, hint=None):
+            local = profiler._local
+            local.init = getattr(local, 'init', 0) + 1
+            try:
+                return init_node(node, hint)
+            finally:
+                local.init -= 1
+
+        PDApp._exchange = _exchange
+        wrapper._init_node = _init_node
+
+    def stop(self):
+        if Profiler._active is not self:
+            return
+        PDApp._exchange, wrapper._init_node = self._saved
+        Profiler._active = None
+
+    def _record(self, cmds, recmsg, elapsed):
+        key = _call_site(sys._getframe(2), self.depth)
+        if getattr(self._local, 'init', 0) or cmds.startswith('help '):
+            kind = 'help'
+        elif cmds.count(';') > 1:
+            kind = 'batch'
+        else:
+            kind = command_kind(cmds)
+
+        with self._lock:
+            site = self.sites.get(key)
+            if site is None:
+                site = self.sites[key] = Site(key)
+            site.round_trips += 1
+            site.kinds[kind] += 1
+            # the length header and terminator of the request
+            site.bytes_sent += len(cmds) + 21
+            site.bytes_recv += len(recmsg or '') + 20
+            site.time += elapsed
+
+    def ranked(self, sort='round_trips'):
+        if sort not in SORT_KEYS:
+            raise ValueError('sort by one of %s' % ', '.join(SORT_KEYS))
+        return sorted(self.sites.values(), key=lambda s: getattr(s, sort),
+                reverse=True)
+
+    def report(self, sort='round_trips', limit=20):
+        """the call sites with the most traffic, as a string"""
+        sites = self.ranked(sort)
+        total = sum(site.round_trips for site in sites)
+        lines = ['%s round trips from %s call sites' % (total, len(sites)),
+                '%7s %6s %6s %6s %6s %6s %10s %8s  %s' % (
+                    'trips', 'help', 'get', 'set', 'call', 'batch', 'bytes',
+                    'seconds', 'site')]
+        for site in sites[:limit]:
+            lines.append('%7d %6d %6d %6d %6d %6d %10d %8.3f  %s:%s (%s)' % (
+                (site.round_trips,) + tuple(site.kinds[k] for k in KINDS) +
+                (site.bytes, site.time, site.filename, site.lineno,
+                    site.function)))
+            lines.append('%42s%s' % ('', site.line()))
+            for filename, lineno, function in site.stack[1:]:
+                lines.append('%42scalled from %s:%s (%s)' % (
+                    '', filename, lineno, function))
+            for tip in site.suggestions():
+                lines.append('%42s-> %s' % ('', tip))
+        return '\n'.join(lines)
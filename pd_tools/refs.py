@@ -0,0 +1,101 @@
+"""lifecycle of the fimmwave variables made by PDApp.ref and PDApp.set"""
+import collections
+import logging
+import weakref
+
+__all__ = ['Ref', 'RefPool']
+logger = logging.getLogger(__name__)
+
+
+class Ref(object):
+    """a fimmwave variable held by wrapped nodes
+
+    Every node wrapped beneath the variable holds on to its Ref, so the
+    variable is released once the last of them is garbage collected, or
+    explicitly by release()."""
+
+    __slots__ = ('name', 'released', '__weakref__')
+
+    def __init__(self, name):
+        self.name = name
+        self.released = False
+
+    def __repr__(self):
+        return '<Ref {name}{state}>'.format(
+            name=self.name, state=' released' if self.released else '')
+
+
+class RefPool(object):
+    """hands out variable names, and takes them back when they are released
+
+    Released variables are freed by a RELEASE_CMD, which the connection sends
+    along with its next command (see drain). Only then is the name reused.
+
+    There is no known fimmwave command to delete a variable, so RELEASE_CMD
+    rebinds it to 0 instead. This assumes that fimmwave lets go of the node
+    a variable held once the variable is rebound, which has not been checked
+    against fimmwave. The variable itself is kept until its name is reused.
+
+    Counts are kept in `stats`, and live() is the number of variables in
+    use."""
+
+    RELEASE_CMD = 'Set {name}=0'
+
+    def __init__(self, prefix='xx'):
+        self.prefix = prefix
+        self.count = 0
+        self._free = []
+        self._live = {}
+        # appended to by garbage collection, possibly from another thread
+        self._released = collections.deque()
+        self.stats = dict.fromkeys(('created', 'reused', 'released'), 0)
+
+    def acquire(self):
+        """returns a Ref to a free variable name"""
+        if self._free:
+            name = self._free.pop()
+            self.stats['reused'] += 1
+        else:
+            name = '{prefix}{idx}'.format(prefix=self.prefix, idx=self.count)
+            self.count += 1
+            self.stats['created'] += 1
+
+        ref = Ref(name)
+        self._live[name] = weakref.ref(ref, self._collected(name))
+        return ref
+
+    def _collected(self, name):
+        def callback(wr):
+            # the name may have been released and handed out again already
+            if self._live.get(name) is wr:
+                self._release(name)
+        return callback
+
+    def release(self, ref):
+        """releases a variable before it is garbage collected"""
+        if not ref.released:
+            ref.released = True
+            self._release(ref.name)
+
+    def _release(self, name):
+        del self._live[name]
+        self._released.append(name)
+        logger.debug('released %s', name)
+
+    def live(self):
+        return len(self._live)
+
+    def pending(self):
+        return len(self._released)
+
+    def drain(self):
+        """returns the commands that free the released variables
+
+        Their names are free for reuse after this."""
+        cmds = []
+        while self._released:
+            name = self._released.popleft()
+            cmds.append(self.RELEASE_CMD.format(name=name))
+            self._free.append(name)
+            self.stats['released'] += 1
+        return cmds
@@ -0,0 +1,153 @@
+"""record the traffic of a session with fimmwave, and replay it without one
+
+    with pd_tools.replay.recording(connection, 'session.trace'):
+        ...  # a real session
+
+    connection = pd_tools.replay.ReplayPDApp('session.trace')
+    with connection as app:
+        ...  # the same script, answered from the trace
+
+A trace holds every message sent and the raw reply to it, so a replay goes
+through the same parsing and wrapper setup as the real session. Replays are
+strict by default: each message sent must be the one that was recorded.
+
+The trace is an append-only binary file: a magic line, then a record per
+exchange of the time it started, the seconds it took, the lengths of the
+message and of the reply (LOST if there was none), the message and the reply.
+"""
+import contextlib
+import logging
+import struct
+import time
+
+from .connection import PDApp
+from .wrapper import wrap
+
+__all__ = ['recording', 'read_trace', 'TraceWriter', 'ReplayPDApp']
+logger = logging.getLogger(__name__)
+
+MAGIC = b'PDTRACE1\n'
+_record = struct.Struct('<ddII')
+LOST = 0xffffffff
+
+
+class TraceWriter(object):
+    """appends exchanges to a trace file"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+    def write(self, started, elapsed, cmds, recmsg):
+        self._file.write(_record.pack(started, elapsed, len(cmds),
+                LOST if recmsg is None else len(recmsg)))
+        self._file.write(cmds)
+        if recmsg is not None:
+            self._file.write(recmsg)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_trace(filename):
+    """yields the (started, elapsed, cmds, recmsg) of each exchange"""
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a trace: %s' % filename)
+        while True:
+            head = f.read(_record.size)
+            if not head:
+                return
+            if len(head) < _record.size:
+                logger.warn('truncated trace: %s', filename)
+                return
+            started, elapsed, ncmds, nreply = _record.unpack(head)
+            cmds = f.read(ncmds)
+            recmsg = None if nreply == LOST else f.read(nreply)
+            yield started, elapsed, cmds, recmsg
+
+
+@contextlib.contextmanager
+def recording(pd_app, filename):
+    """records the exchanges of a connection to a trace file"""
+    writer = TraceWriter(filename)
+    exchange = pd_app._exchange
+
+    def _exchange(cmds):
+        started = time.time()
+        recmsg = exchange(cmds)
+        writer.write(started, time.time() - started, cmds, recmsg)
+        return recmsg
+
+    pd_app._exchange = _exchange
+    try:
+        yield writer
+    finally:
+        del pd_app._exchange
+        writer.close()
+
+
+class _TraceSocket(object):
+    """stands in for the socket of a replayed connection"""
+
+    def close(self):
+        pass
+
+
+class ReplayPDApp(PDApp):
+    """a connection that answers from a trace instead of fimmwave
+
+    With strict, every message must match the recorded one, or ValueError is
+    raised. Otherwise the recorded replies are returned in order whatever is
+    sent. With realtime, each reply takes as long as it did when recorded.
+    Takes the same keyword arguments as PDApp otherwise."""
+
+    def __init__(self, trace, strict=True, realtime=False, **kwargs):
+        PDApp.__init__(self, **kwargs)
+        self.trace = trace
+        self.strict = strict
+        self.realtime = realtime
+        self.replayed = 0
+        self._records = None
+
+    def __enter__(self):
+        self.connect()
+        return wrap(self, 'app')
+
+    def connect(self, host=None, port=None):
+        if self.appSock:
+            raise ValueError('already connected')
+        self._reset()
+        self._records = read_trace(self.trace)
+        self.replayed = 0
+        self.appSock = _TraceSocket()
+        self._port = None
+
+    def _exchange(self, cmds):
+        try:
+            started, elapsed, recorded, recmsg = next(self._records)
+        except StopIteration:
+            raise ValueError('trace exhausted after %s exchanges: %s' % (
+                self.replayed, repr(cmds)))
+        if self.strict and recorded != cmds:
+            raise ValueError('exchange %s differs from the trace: %s, not %s'
+                    % (self.replayed, repr(cmds), repr(recorded)))
+        if self.realtime:
+            time.sleep(elapsed)
+        if self.recorder is not None:
+            # all of the recorded time is put down to waiting
+            self._sample = {
+                'cmds': cmds.count(';'),
+                'bytes_sent': len(cmds),
+                'bytes_recv': len(recmsg or ''),
+                'send': 0.,
+                'wait': elapsed,
+                'recv': 0.,
+            }
+            if recmsg is None:
+                self._record_sample('lost', 0.)
+        self.replayed += 1
+        return recmsg
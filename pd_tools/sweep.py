@@ -0,0 +1,348 @@
+"""parameter sweeps that stream their results to disk and can be resumed
+
+A sweep runs a function on every point of a grid of parameters:
+
+    def solve(app, point):
+        wg, variables = app.subnodes[1], app.subnodes[2]
+        variables.setvariable('t_clad_u', point['t_up'])
+        variables.setvariable('w_core', point['w_core'])
+        wg.evlist.update()
+        return [mode.neff() for mode in wg.evlist.list]
+
+    sweep = Sweep([('t_up', (0.4, 0.5)), ('w_core', widths)], solve,
+            'neffs.jsonl')
+    with PDAppPool(4, path=FIMMWAVE, setup=build) as pool:
+        sweep.run(pool)
+
+Each result is appended to the results file as a line of JSON as soon as it
+is done. Running the sweep again skips the points already in the file, so an
+interrupted sweep resumes where it stopped. Points that failed are logged,
+and retried by the next run.
+
+Changing some parameters costs more than others, e.g. the mesh forces a
+rebuild while mintefrac only filters modes. Given the setters of the
+parameters and the costs of changing them, a sweep orders its points so that
+costly parameters change least, and each point only sets the parameters that
+differ from the point before it on the same connection:
+
+    sweep = Sweep(axes, solve, 'neffs.jsonl',
+            setters={'nx': set_nx, 'w_core': set_w_core},
+            costs={'nx': 100, 'w_core': 10})
+"""
+import collections
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+import numpy
+
+__all__ = ['Sweep', 'load_results']
+logger = logging.getLogger(__name__)
+
+
+def _to_json(obj):
+    """encodes what json can't: complex numbers and numpy values"""
+    if isinstance(obj, complex):
+        return {'__complex__': [obj.real, obj.imag]}
+    elif isinstance(obj, numpy.ndarray):
+        if numpy.iscomplexobj(obj):
+            return {'__complex__': [obj.real.tolist(), obj.imag.tolist()]}
+        return obj.tolist()
+    elif isinstance(obj, numpy.generic):
+        return _to_json(obj.item()) if numpy.iscomplexobj(obj) else obj.item()
+    raise TypeError('%s is not JSON serializable' % repr(obj))
+
+
+def _from_json(obj):
+    if '__complex__' in obj:
+        real, imag = obj['__complex__']
+        if isinstance(real, list):
+            return numpy.array(real) + 1j*numpy.array(imag)
+        return complex(real, imag)
+    return obj
+
+
+def _dumps(obj):
+    return json.dumps(obj, default=_to_json, sort_keys=True)
+
+
+def _snake(lengths):
+    """yields the index tuples of a grid in reflected Gray code order
+
+    Consecutive tuples differ by one step in a single index, the last index
+    changing fastest."""
+    if not lengths:
+        yield ()
+        return
+    inner = list(_snake(lengths[1:]))
+    for i in range(lengths[0]):
+        for rest in (inner if i % 2 == 0 else reversed(inner)):
+            yield (i,) + rest
+
+
+def load_results(filename):
+    """yields the records of a results file, skipping unreadable lines
+
+    Each record is a dict with the index and the point it was run at, the
+    seconds it took, and either the result or the error it failed with."""
+    if not os.path.exists(filename):
+        return
+    with open(filename) as f:
+        for line in f:
+            try:
+                yield json.loads(line, object_hook=_from_json)
+            except ValueError:
+                # most likely the last line of an interrupted run
+                logger.warn('skipping unreadable line in %s', filename)
+
+
+class Sweep(object):
+    """runs func(app, point) on each point of a grid
+
+    axes are the (name, values) pairs of the grid, in the order they are
+    nested, the last varying fastest. A dict is nested by name. Points are
+    dicts of a value by name. Results must be JSON serializable, except for
+    complex numbers and numpy values, which are taken care of.
+
+    setters are functions setter(app, value) by parameter name. Before each
+    point, the setters of the parameters that changed since the previous
+    point on the same connection are called, so that func only has to solve.
+    If func is memo.memoized, points found in its store are answered without
+    calling the setters.
+
+    order is the order of the points:
+
+    - 'grid' runs them in the order of the grid
+    - 'snake' runs them in reflected Gray code order, so that only one
+      parameter changes from one point to the next
+    - 'cost' nests the axes by the costs of changing them, most costly
+      outermost, and runs them as a snake
+
+    It defaults to 'cost' if costs are given, and 'grid' otherwise."""
+
+    ORDERS = ('grid', 'snake', 'cost')
+
+    def __init__(self, axes, func, filename, setters=None, costs=None,
+            order=None):
+        if isinstance(axes, dict):
+            axes = sorted(axes.items())
+        self.axes = collections.OrderedDict(
+            (name, list(values)) for name, values in axes)
+        self.func = func
+        self.filename = filename
+        self.setters = setters or {}
+        self.costs = costs or {}
+        if order is None:
+            order = 'cost' if costs else 'grid'
+        if order not in self.ORDERS:
+            raise ValueError('unknown order %s' % repr(order))
+        self.order = order
+
+        # the last point set on each connection
+        self._applied = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        n = 1
+        for values in self.axes.values():
+            n *= len(values)
+        return n
+
+    def points(self):
+        """yields the index and point of each point of the grid, in order
+
+        The index is the position of the point in the grid, whatever the
+        order."""
+        names = list(self.axes)
+        if self.order == 'grid':
+            for i, values in enumerate(
+                    itertools.product(*self.axes.values())):
+                yield i, dict(zip(names, values))
+            return
+
+        if self.order == 'cost':
+            # stable, so axes of equal cost stay in the order given
+            names.sort(key=lambda name: -self.costs.get(name, 1))
+        lengths = [len(self.axes[name]) for name in names]
+        # to find the index of the points in the grid
+        strides = {}
+        stride = 1
+        for name in reversed(list(self.axes)):
+            strides[name] = stride
+            stride *= len(self.axes[name])
+
+        for idx in _snake(lengths):
+            point = dict((name, self.axes[name][i])
+                    for name, i in zip(names, idx))
+            index = sum(i*strides[name] for name, i in zip(names, idx))
+            yield index, point
+
+    def transition_cost(self, points=None):
+        """the total cost of the parameter changes between points
+
+        Counts the first point as changing everything. Parameters without a
+        cost cost 1."""
+        if points is None:
+            points = [point for i, point in self.points()]
+        total = 0
+        previous = {}
+        for point in points:
+            total += sum(self.costs.get(name, 1)
+                    for name, value in point.items()
+                    if name not in previous or previous[name] != value)
+            previous = point
+        return total
+
+    @staticmethod
+    def _key(point):
+        return _dumps(point)
+
+    def completed(self):
+        """the keys of the points that have a result in the file"""
+        return set(self._key(record['point'])
+                for record in load_results(self.filename)
+                if 'result' in record)
+
+    def pending(self):
+        done = self.completed()
+        return [(i, point) for i, point in self.points()
+                if self._key(point) not in done]
+
+    def results(self):
+        """the results in the file by index, for the points of the grid"""
+        index = dict((self._key(point), i) for i, point in self.points())
+        results = {}
+        for record in load_results(self.filename):
+            i = index.get(self._key(record['point']))
+            if i is not None and 'result' in record:
+                results[i] = record['result']
+        return results
+
+    def run(self, target):
+        """runs the points that have no result yet
+
+        target is a PDAppPool to run the points in parallel, or a wrapped
+        app to run them one after the other. Returns the number of points
+        that failed."""
+        pending = self.pending()
+        logger.info('%s of %s points to run', len(pending), len(self))
+        if not pending:
+            return 0
+
+        logger.info('transition cost %s', self.transition_cost(
+            [point for i, point in pending]))
+        with open(self.filename, 'a') as f:
+            if hasattr(target, 'submit'):
+                records = self._run_pool(target, pending)
+            else:
+                records = (self._solve(target, i, point)[0]
+                        for i, point in pending)
+
+            failed = 0
+            for n, record in enumerate(records, 1):
+                f.write(_dumps(record) + '\n')
+                f.flush()
+                if 'error' in record:
+                    failed += 1
+                    logger.error('point %s failed: %s', record['index'],
+                            record['error'])
+                logger.info('%s/%s points done', n, len(pending))
+        return failed
+
+    def _apply(self, app, point):
+        """calls the setters of the parameters that changed on app"""
+        key = id(app._pd_app)
+        with self._lock:
+            previous = self._applied.pop(key, {})
+        for name, setter in self.setters.items():
+            if name in previous and previous[name] == point[name]:
+                continue
+            setter(app, point[name])
+        with self._lock:
+            self._applied[key] = point
+
+    def _solve(self, app, index, point):
+        """returns the record of a point, and the exception if it failed"""
+        start = time.time()
+        record = {'index': index, 'point': point}
+        error = None
+        try:
+            lookup = getattr(self.func, 'lookup', None)
+            try:
+                if lookup is None:
+                    raise KeyError(point)
+                # a memo hit needs no setters, see memo.memoized
+                record['result'] = lookup(point)
+            except KeyError:
+                if self.setters:
+                    self._apply(app, point)
+                compute = getattr(self.func, 'compute', self.func)
+                record['result'] = compute(app, point)
+        except Exception as e:
+            record['error'] = repr(e)
+            error = e
+            if self.setters:
+                # the state of the connection is unknown now
+                with self._lock:
+                    self._applied.pop(id(app._pd_app), None)
+        record['elapsed'] = time.time() - start
+        return record, error
+
+    def _run_pool(self, pool, pending):
+        """yields the records of the pending points as they finish
+
+        Unless in grid order, the points are split into one run of
+        consecutive points per worker, to keep the changes between them
+        small."""
+        done = Queue.Queue()
+
+        def job(app, run):
+            for n, (index, point) in enumerate(run):
+                record, error = self._solve(app, index, point)
+                done.put(record)
+                if isinstance(error, socket.error):
+                    for index, point in run[n+1:]:
+                        done.put({'index': index, 'point': point,
+                            'error': 'not run: %s' % repr(error)})
+                    # let the pool replace the instance
+                    raise error
+
+        if self.order == 'grid':
+            size = 1
+        else:
+            size = -(-len(pending) // pool.max_workers)
+        jobs = []
+        for start in range(0, len(pending), size):
+            run = pending[start:start+size]
+            jobs.append((pool.submit(job, run), run))
+
+        outstanding = set(index for index, point in pending)
+        while outstanding:
+            try:
+                record = done.get(timeout=0.5)
+            except Queue.Empty:
+                if not all(future.done() for future, run in jobs):
+                    continue
+                # the jobs are over, e.g. they found no instance to run on
+                while not done.empty():
+                    record = done.get()
+                    outstanding.discard(record['index'])
+                    yield record
+                for future, run in jobs:
+                    for index, point in run:
+                        if index in outstanding:
+                            outstanding.discard(index)
+                            yield {'index': index, 'point': point,
+                                'error': 'not run: %r' % future.exception()}
+                continue
+            outstanding.discard(record['index'])
+            yield record
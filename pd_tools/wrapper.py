@@ -5,12 +5,15 @@ Script in python like it was the fimmwave command prompt! Proxies all
 accessors, function calls and assignment to fimmwave via variety of magic
 methods
 """
+import json
+import os
 import re
 import logging
+import numbers
 import sys
 logger = logging.getLogger(__name__)
 
-__all__ = ['wrap']
+__all__ = ['wrap', 'SchemaCache']
 
 _linepat = re.compile(r"""
             \s*(?P<name>\S+)\s+ # the name
@@ -24,61 +27,238 @@ _linepat = re.compile(r"""
 _typepat = re.compile(r'\s+(?P<nodetype>\S+)')
 
 
-def wrap(pd_app, path='app'):
-    return _get_node(pd_app, path)
-
+def wrap(pd_app, path='app', owner=None):
+    return _get_node(pd_app, path, owner=owner)
+
+
+def _get_node(pd_app, path, nodetype=None, provisional=False, owner=None):
+    """returns a handle for the node at path
+
+    Handles are light objects holding just the path. Their class holds the
+    schema, and is shared by all nodes of the same type. nodetype is the type
+    of the node, if known, and provisional marks it as a guess to be checked
+    if it turns out wrong. A handle of unknown type is initialized from its
+    help, unless batch mode is ON."""
+    if nodetype is None:
+        nodetype = pd_app._path_types.get(path)
+
+    cls = _node_class(pd_app, nodetype)
+    if cls is None:
+        node = _new_handle(_uninitialized_class(pd_app), path, False, owner)
+        if not pd_app.batch:
+            _init_node(node, nodetype)
+    else:
+        node = _new_handle(cls, path, provisional, owner)
+    return node
+
+
+def _new_handle(cls, path, provisional=False, owner=None):
+    node = cls.__new__(cls)
+    object.__setattr__(node, '_path', path)
+    object.__setattr__(node, '_provisional', provisional)
+    object.__setattr__(node, '_owner', owner)
+    return node
+
+
+def _uninitialized_class(pd_app):
+    if None not in pd_app._cls_cache:
+        pd_app._cls_cache[None] = type('Node', (Node,), {
+            '__slots__': (),
+            '_pd_app': pd_app,
+            '_nodetype': None,
+            '_initialized': False,
+            '_from_cache': False,
+        })
+    return pd_app._cls_cache[None]
+
+
+def _node_class(pd_app, nodetype):
+    """returns the class for a node type, or None if its schema is unknown"""
+    if nodetype is None:
+        return None
+    if nodetype not in pd_app._cls_cache:
+        schema = _cached_schema(pd_app, nodetype)
+        if schema is None:
+            return None
+        _create_node_class(pd_app, schema, from_cache=True)
+    return pd_app._cls_cache[nodetype]
+
+
+def _create_node_class(pd_app, schema, from_cache=False):
+    attrs = {
+        '__slots__': (),
+        '_pd_app': pd_app,
+        '_initialized': True,
+    }
 
-def _get_node(pd_app, path):
-    if path not in pd_app._cls_cache:
-        _create_node_class(pd_app, path)
-    cls = pd_app._cls_cache[path]
+    cls = type(str(schema['nodetype']), (Node,), attrs)
+    _setup_node_class(cls, schema, from_cache)
 
-    if not pd_app.batch and not cls._initialized:
-        _init_node_class(cls)
+    pd_app._cls_cache[schema['nodetype']] = cls
+    logger.debug('added %s to cache' % repr(schema['nodetype']))
+    return cls
 
-    return cls()
 
+def _cached_schema(pd_app, nodetype):
+    if nodetype is None or pd_app.schema_cache is None:
+        return None
+    return pd_app.schema_cache.get(nodetype)
 
-def _create_node_class(pd_app, path):
-    attrs = {
-        '_pd_app': pd_app,
-        '_path': path,
-        '_initialized': False,
-    }
 
-    cls = type(path, (Node,), attrs)
+def _init_node(node, hint=None):
+    """initializes a handle of unknown type from its help
 
-    assert path not in pd_app._cls_cache
-    pd_app._cls_cache[path] = cls
+    hint is the type the node was listed as by its parent, which usually is
+    its type. If not, the class is filed under both."""
+    pd_app = node._pd_app
+    schema = _schema_from_help(_get_help(pd_app, node._path))
+    nodetype = schema['nodetype']
 
-    logger.debug('added %s to cache' % repr(path))
+    cls = pd_app._cls_cache.get(nodetype)
+    if cls is None:
+        cls = _create_node_class(pd_app, schema)
+    elif cls._from_cache:
+        _check_node_class(cls, schema)
 
+    if pd_app.schema_cache is not None:
+        pd_app.schema_cache.update(schema)
 
-def _init_node_class(cls):
-    """initializes the node from its help"""
+    if hint is not None and hint != nodetype:
+        pd_app._cls_cache[hint] = cls
+    pd_app._path_types[node._path] = nodetype
+    object.__setattr__(node, '__class__', cls)
+    object.__setattr__(node, '_provisional', False)
+    logger.debug('initialized %s' % repr(node._path))
 
-    assert cls._initialized is False
-    cls._initialized = True
-
-    raw_help = _get_help(cls._pd_app, cls._path)
-    info = _parse_help(raw_help)
-    nodetype = info['matchdict']['nodetype']
 
+def _setup_node_class(cls, schema, from_cache=False):
+    """sets up the attributes of a node class from its schema"""
     attrs = {
-        attribute['name']: Attribute(attribute['name'], attribute['nodetype'])
-        for attribute in info['attributes']
+        name: Attribute(name, nodetype)
+        for name, nodetype in schema['attributes']
     }
 
-    attrs['_nodetype'] = nodetype
+    attrs['_nodetype'] = schema['nodetype']
+    attrs['_schema'] = schema
+    attrs['_from_cache'] = from_cache
 
     if sys.version_info >= (3,3):
         # docstrings not mutable until Python 3.3
-        attrs['__doc__'] = raw_help
+        attrs['__doc__'] = schema['help']
 
     for key, val in attrs.items():
         setattr(cls, key, val)
 
-    logger.debug('initialized %s' % repr(cls._path))
+
+def _check_node_class(cls, schema):
+    """checks a node class against a schema from help, updating it if needed
+
+    Returns whether the class was updated."""
+    cls._from_cache = False
+    if cls._schema['attributes'] == schema['attributes']:
+        return False
+
+    logger.info('help for %s disagrees with the schema cache' % cls._nodetype)
+    for name, nodetype in cls._schema['attributes']:
+        if isinstance(cls.__dict__.get(name), Attribute):
+            delattr(cls, name)
+    _setup_node_class(cls, schema)
+    if cls._pd_app.schema_cache is not None:
+        cls._pd_app.schema_cache.update(schema)
+    return True
+
+
+def _revalidate_node(node):
+    """checks a node that may have been set up wrongly against its help
+
+    This is the case for nodes whose class came from the schema cache, and
+    for provisional nodes whose type was guessed. Returns whether anything
+    was corrected."""
+    if node._pd_app.batch or not (node._provisional or node._from_cache):
+        return False
+
+    pd_app = node._pd_app
+    schema = _schema_from_help(_get_help(pd_app, node._path))
+    object.__setattr__(node, '_provisional', False)
+
+    if schema['nodetype'] != node._nodetype:
+        logger.info('%s is a %s, not a %s' % (
+            node._path, schema['nodetype'], node._nodetype))
+        cls = pd_app._cls_cache.get(schema['nodetype'])
+        if cls is None:
+            cls = _create_node_class(pd_app, schema)
+        pd_app._path_types[node._path] = schema['nodetype']
+        object.__setattr__(node, '__class__', cls)
+        return True
+
+    return _check_node_class(node.__class__, schema)
+
+
+def _schema_from_help(raw_help):
+    info = _parse_help(raw_help)
+    return {
+        'nodetype': info['matchdict']['nodetype'],
+        'attributes': [
+            [attribute['name'], attribute['nodetype']]
+            for attribute in info['attributes']],
+        'help': raw_help,
+    }
+
+
+class SchemaCache(object):
+    """persistent cache of node schemas, keyed by node type
+
+    A schema is the list of attributes of a node type, as parsed from the
+    help of a node of that type. With a schema cache, nodes of a known type
+    are set up without asking fimmwave for help, also across sessions.
+    Schemas are stored in a json file, separately for each `version` of
+    fimmwave (any string that changes when fimmwave does). The version is
+    required, so that schemas of different builds never mix.
+
+    Nodes set up from the cache ask for their help after all if they are
+    missing an attribute, and the cache is updated if the help disagrees.
+
+        cache = SchemaCache('schemas.json', version='fimmwave 6.5')
+        connection = PDApp(path=FIMMWAVE, schema_cache=cache)
+    """
+
+    def __init__(self, filename, version):
+        if version is None or not '%s' % version:
+            raise ValueError('the version of fimmwave is required')
+        self.filename = filename
+        self.version = '%s' % version
+        self._dirty = False
+
+        self._all = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                self._all = json.load(f)
+        self._schemas = self._all.setdefault(self.version, {})
+
+    def get(self, nodetype):
+        return self._schemas.get(nodetype)
+
+    def update(self, schema):
+        if self._schemas.get(schema['nodetype']) != schema:
+            self._schemas[schema['nodetype']] = schema
+            self._dirty = True
+
+    def save(self):
+        """writes the cache to its file, if anything changed"""
+        if not self._dirty:
+            return
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._all, f)
+        if os.path.exists(self.filename):
+            os.remove(self.filename) # rename won't replace on windows
+        os.rename(tmp, self.filename)
+        self._dirty = False
+
+
+# marks a value missing from the value cache
+_missing = object()
+
 
 def _join_path(path, attrname):
     return '{path}.{name}'.format(path=path, name=attrname)
@@ -144,34 +324,90 @@ def _convert_arg(arg):
     return '%s' % arg if type(arg) is str else repr(arg)
 
 
+def _field_path(node, name):
+    """the path of an attribute to read, or a function to call, on a node
+
+    name may be a dotted path beneath the node, and ends in '()' for a
+    function call. Attributes known to be functions are called by name
+    alone."""
+    path = _join_path(node._path, name)
+    attr = getattr(node.__class__, name, None)
+    if isinstance(attr, Attribute) and attr.nodetype == Node.FUNCTION_TYPE:
+        path = _call_cmd(path, ())
+    return path
+
+
 class Attribute(object):
     def __init__(self, name, nodetype):
         self.name = name
         self.nodetype = nodetype
 
     def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
         path = _join_path(instance._path, self.name)
 
         if self.nodetype in Node.PRIMITIVE_TYPES:
-            return instance._pd_app.do_raise(path)
+            pd_app = instance._pd_app
+            if pd_app.batch:
+                # a future, resolved on flush
+                return pd_app.do(path)
+
+            cache = pd_app.value_cache
+            if cache is not None:
+                value = cache.get(path, _missing)
+                if value is not _missing:
+                    return value
+
+            if self.nodetype == Node.MATRIX_TYPE and pd_app.numpy_matrices:
+                value = pd_app.get_array(path)
+            else:
+                value = pd_app.do_raise(path)
+
+            if cache is not None:
+                cache.put(path, value)
+            return value
         else:
-            if not hasattr(self, '_cached_node'):
-                self._cached_node = _get_node(instance._pd_app, path)
-            return self._cached_node
+            return _get_node(instance._pd_app, path, self.nodetype,
+                    owner=instance._owner)
 
     def __set__(self, instance, value):
         if self.nodetype in Node.PRIMITIVE_TYPES:
-            return instance._pd_app.do(
-                _assign_cmd(instance._path, self.name, value))
+            pd_app = instance._pd_app
+            r = pd_app.do(_assign_cmd(instance._path, self.name, value))
+            if pd_app.value_cache is not None and not pd_app.batch:
+                self._write_through(pd_app.value_cache,
+                        _join_path(instance._path, self.name), value)
+            return r
         else:
             raise TypeError('not a primitive: %s' % self)
 
+    def _write_through(self, cache, path, value):
+        """caches an assigned value as it will be read back
+
+        Numbers are read back as floats. Other values are left to be read."""
+        if (self.nodetype in ('INTEGER', 'FLOAT') and
+                isinstance(value, numbers.Real) and
+                not isinstance(value, bool)):
+            cache.put(path, float(value))
+
     def __str__(self):
         return '{n}[{t}]'.format(n=self.name, t=self.nodetype)
 
 class Node(object):
+    """a handle on a fimmwave node
+
+    The class of a handle carries the schema of the node type, and is shared
+    by all the nodes of that type on a connection. The handle itself only
+    holds the path, and the refs.Ref of the variable it lies beneath, if any.
+    Used as a context manager, a node releases that variable on exit."""
+
+    __slots__ = ('_path', '_provisional', '_owner', '__weakref__')
+
     FUNCTION_TYPE = 'FUNCTION'
     LIST_TYPE = 'LIST'
+    MATRIX_TYPE = 'MATRIX<COMPLEX>'
     PRIMITIVE_TYPES = (
         'INTEGER',
         'FLOAT',
@@ -184,7 +420,7 @@ class Node(object):
         if self._initialized:
             # initialized, do it
             if self._nodetype.startswith(self.LIST_TYPE):
-                node = _get_node(self._pd_app, _idx_path(self._path, idx))
+                node = self._get_item(idx)
                 if node._nodetype in self.PRIMITIVE_TYPES:
                     return node.__get__(self)
                 else:
@@ -193,13 +429,39 @@ class Node(object):
                 raise TypeError('not a list')
         elif self._pd_app.batch:
             # not initialized, but batch mode so flying blind
-            return _get_node(self._pd_app, _idx_path(self._path, idx))
+            return _get_node(self._pd_app, _idx_path(self._path, idx),
+                    owner=self._owner)
         else:
             # batch mode is off, but not initialized, so initialize it and try
             # again
-            _init_node_class(self.__class__)
+            _init_node(self)
             return self[idx]
 
+    def _get_item(self, idx, infer=False):
+        """returns the handle of an element of this list
+
+        With infer, or infer_item_types on the connection, elements are
+        assumed to be of the same type as the other elements of lists of this
+        name and type, unless they have been seen to differ. Such a guess is
+        checked against the help of the element if it is missing an
+        attribute."""
+        pd_app = self._pd_app
+        path = _idx_path(self._path, idx)
+        if (not (infer or pd_app.infer_item_types) or
+                path in pd_app._path_types):
+            return _get_node(pd_app, path, owner=self._owner)
+
+        key = (self._nodetype, self._path.rsplit('.', 1)[-1].split('[')[0])
+        item_type = pd_app._item_types.get(key)
+        if item_type:
+            return _get_node(pd_app, path, item_type, provisional=key,
+                    owner=self._owner)
+
+        node = _get_node(pd_app, path, owner=self._owner)
+        if node._initialized and item_type is None:
+            pd_app._item_types[key] = node._nodetype
+        return node
+
     def __len__(self):
         """does nothing if batch mode is ON"""
         if self._initialized:
@@ -216,36 +478,92 @@ class Node(object):
         elif self._pd_app.batch:
             raise ValueError('batch mode is ON')
         else:
-            _init_node_class(self.__class__)
+            _init_node(self)
             return len(self)
 
     def __getattr__(self, key):
         """does nothing special if this is initialized (delegate to attribute),
         if it is not initialized and batch mode OFF, initialize, then delegate.
         otherwise calls _get_node for a child attribute"""
-        if self._initialized:
-            object.__getattribute__(self, key)
+        if key.startswith('__'):
+            raise AttributeError(key)
+        elif self._initialized:
+            if self._provisional or self._from_cache:
+                self._revalidate()
+                if hasattr(self.__class__, key):
+                    return getattr(self, key)
+            raise AttributeError('{path} has no {key}'.format(
+                path=self._path, key=key))
         elif self._pd_app.batch:
-            return _get_node(self._pd_app, _join_path(self._path, key))
+            return _get_node(self._pd_app, _join_path(self._path, key),
+                    owner=self._owner)
         else:
-            _init_node_class(self.__class__)
+            _init_node(self)
             return getattr(self, key)
 
     def __setattr__(self, key, value):
         """if this instance is initialized, do nothing special (delegate to
         attribute). if not initialized, add cmd"""
         if self._initialized:
+            if not hasattr(self.__class__, key):
+                self._revalidate()
             object.__setattr__(self, key, value)
         elif self._pd_app.batch:
             self._pd_app.do(_assign_cmd(self._path, key, value))
         else:
-            _init_node_class(self.__class__)
+            _init_node(self)
             setattr(self, key, value)
 
+    def _revalidate(self):
+        """if the schema of this node may be wrong, check it against help"""
+        key = self._provisional
+        if _revalidate_node(self) and key:
+            # guessed the type wrong, so stop guessing for such lists
+            self._pd_app._item_types[key] = False
+
     def __iter__(self):
         for i in range(1,len(self)+1):
             yield self[i]
 
+    def iter_fields(self, *fields, **kwargs):
+        """iterates over this list, reading fields of the elements in pages
+
+        Without fields, yields the elements, assuming they are all of the
+        type of the first one (see _get_item). With fields, which are named
+        as in get_many, yields a tuple of the fields of each element, or the
+        field itself if there is only one. The fields of page_size elements
+        (default 100) are read in one round trip, so the whole list takes
+        two round trips plus one per page."""
+        page_size = kwargs.pop('page_size', 100)
+        if kwargs:
+            raise TypeError('unexpected arguments: %s' % ', '.join(kwargs))
+        if page_size < 1:
+            raise ValueError('page_size must be positive')
+
+        n = len(self)
+        if n == 0:
+            return
+        items = (self._get_item(i, infer=True) for i in range(1, n+1))
+        if not fields:
+            for item in items:
+                yield item
+            return
+
+        pd_app = self._pd_app
+        page = []
+        for i, item in enumerate(items, 1):
+            page.extend(_field_path(item, field) for field in fields)
+            if i % page_size and i < n:
+                continue
+
+            values = pd_app.get_paths(page)
+            page = []
+            for j in range(0, len(values), len(fields)):
+                if len(fields) == 1:
+                    yield values[j]
+                else:
+                    yield values[j:j+len(fields)]
+
     def __call__(self, *args, **kwargs):
         """if initialized, callable. if not initialized, still callable
         (without checks)"""
@@ -265,8 +583,22 @@ class Node(object):
             else:
                 return self._pd_app.do(cmd)
         else:
-            _init_node_class(self.__class__)
-            return self(*args)
+            _init_node(self)
+            return self(*args, **kwargs)
+
+    def get_many(self, names):
+        """reads several attributes in one round trip, see PDApp.get_paths
+
+        names are attribute names, or dotted paths beneath this node.
+        Functions are called without arguments, either by adding '()' to the
+        name, or by name alone for attributes known to be functions. Returns
+        a dict of the values by name."""
+        if not self._initialized and not self._pd_app.batch:
+            _init_node(self)
+
+        names = list(names)
+        paths = [_field_path(self, name) for name in names]
+        return dict(zip(names, self._pd_app.get_paths(paths)))
 
     def __str__(self):
         return '{path}[{nodetype}]'.format(
@@ -276,5 +608,13 @@ class Node(object):
         return '<Node {path}[{nodetype}]>'.format(
             path=self._path, nodetype=self._nodetype)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """releases the variable behind a node made by ref or set"""
+        if self._owner is not None:
+            self._pd_app.refs.release(self._owner)
+
     def help(self):
         print(_get_help(self._pd_app, self._path))
@@ -0,0 +1,58 @@
+"""Smoke test for pd_tools.aio.AsyncPDApp
+
+Drives a few local pd_tools.mockserver instances from one event loop: wraps
+their apps, reads, assigns and calls on each of them concurrently, and checks
+the replies. Needs Python 3.5 or later.
+
+usage: python3 smoke_aio.py [--instances 3]
+"""
+import argparse
+import asyncio
+
+from pd_tools.aio import AsyncPDApp
+from pd_tools.mockserver import MockServer, demo_tree
+
+
+async def exercise(port, width):
+    async with AsyncPDApp('localhost', port) as app:
+        assert app._nodetype == 'fimmwave_app', app
+        assert await app.version == 'mock'
+
+        wg = app.subnodes[1]
+        await wg.width.set(width)
+        assert await wg.width == width
+
+        mode = await app.subnodes[1].evlist.list[2].wrap()
+        assert mode._nodetype == 'EVDATA', mode
+        assert await mode.neff() == complex(1.59, 1e-7)
+        assert len(await wg.evlist.list) == 4
+        return width
+
+
+async def exercise_all(ports):
+    return await asyncio.gather(*[exercise(port, 1.0 + i)
+            for i, port in enumerate(ports)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--instances', type=int, default=3)
+    args = parser.parse_args()
+
+    servers = [MockServer(demo_tree()) for i in range(args.instances)]
+    for server in servers:
+        server.start()
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(exercise_all(
+                [server.port for server in servers]))
+        assert results == [1.0 + i for i in range(args.instances)]
+    finally:
+        loop.close()
+        for server in servers:
+            server.stop()
+    print('ok: %s instances' % args.instances)
+
+
+if __name__ == '__main__':
+    main()